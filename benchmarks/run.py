@@ -0,0 +1,259 @@
+"""
+Benchmarks of the data -> strategy -> backtest pipeline, on synthetic
+market data generated in a temporary folder, without network access
+
+    python benchmarks/run.py --coins 50 --years 3 --output results.json
+    python benchmarks/run.py --compare before.json after.json
+"""
+
+import argparse
+import json
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import date, timedelta
+
+import numpy as np
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+CONFIG = """alpha = {alpha}
+n_coins = {n_coins}
+cap = {cap}
+loss = {loss}
+r = {r}
+start = "{start}"
+"""
+
+
+def measure(fn, setup=None, repeat=3, memory=True):
+    """
+    Wall time of repeat runs, and peak traced memory of one more run
+    """
+
+    times = list()
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        begin = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - begin)
+
+    result = {
+        "min": min(times),
+        "median": statistics.median(times),
+        "repeat": repeat,
+    }
+    if memory:
+        if setup is not None:
+            setup()
+        tracemalloc.start()
+        fn()
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        result["peak_mb"] = peak / 2**20
+    return result
+
+
+def commit():
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "HEAD"], cwd=ROOT, stderr=subprocess.DEVNULL
+        ).decode()[:-1]
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(coins, years, repeat, memory, workers, seed):
+    """
+    Run every benchmark in a temporary workspace
+    """
+
+    workspace = tempfile.mkdtemp(prefix="krypfolio-bench-")
+    start = (date.today() - timedelta(days=int(365 * years) - 60)).isoformat()
+    with open(os.path.join(workspace, "config.py"), "w") as f:
+        f.write(
+            CONFIG.format(
+                alpha=3, n_coins=min(10, coins), cap=0.18, loss=0.12, r=2, start=start
+            )
+        )
+    sys.path[:0] = [workspace, ROOT]
+    cwd = os.getcwd()
+    os.chdir(workspace)
+
+    # The modules read ./data and ./strategies relative to the workspace
+    from benchmarks import synthetic
+    from data import vendor
+    from data.manifest import Manifest
+    from data.market import MarketStore
+    from execution import hyperopt, search
+    from execution.backtest import Krypfolio
+    from strategies.hodl import HODL
+
+    results = dict()
+
+    def bench(name, fn, setup=None):
+        print(name)
+        results[name] = measure(fn, setup, repeat, memory)
+
+    try:
+        data = synthetic.series(coins, years, seed)
+        synthetic.write_raw(data)
+        os.makedirs("./data/processed")
+        os.makedirs("./strategies")
+        manifest = Manifest()
+        manifest.index()
+        symbols = list(data.keys())
+
+        # Data stage
+        def reset_consolidation():
+            shutil.rmtree("./data/consolidated", ignore_errors=True)
+            manifest.db.execute("DELETE FROM consolidated")
+            manifest.db.commit()
+
+        bench(
+            "vendor.consolidate",
+            lambda: vendor.consolidate(symbols, manifest),
+            reset_consolidation,
+        )
+
+        # The processed CSVs are written from the consolidated ones
+        for method in vendor.detectors:
+            bench(
+                "vendor.clean[{}]".format(method),
+                lambda: vendor.clean(method=method, workers=workers),
+            )
+        shutil.rmtree("./data/processed")
+        shutil.copytree("./data/consolidated", "./data/processed")
+
+        bench(
+            "MarketStore.import_csv",
+            lambda: MarketStore().import_csv(),
+            lambda: shutil.rmtree("./data/market", ignore_errors=True),
+        )
+
+        # Strategy stage
+        hodl = HODL(3, min(10, coins), 0.18)
+        bench(
+            "HODL.weighted_market_cap",
+            hodl.weighted_market_cap,
+            lambda: shutil.rmtree("./data/features", ignore_errors=True),
+        )
+        feature = "ewma_market_cap_3_days"
+        hodl.load_panel([feature, "close"])
+        days = [
+            d.astype(object) for d in hodl.panel.dates[-30:].astype("datetime64[s]")
+        ]
+        bench(
+            "HODL.data_at_date",
+            lambda: [hodl.data_at_date(d, [feature, "close"]) for d in days],
+        )
+        bench("HODL.allocate", lambda: [hodl.allocate(d) for d in days])
+        all_days = [d.astype(object) for d in hodl.panel.dates.astype("datetime64[s]")]
+        bench("HODL.allocate_all", lambda: hodl.allocate_all(all_days))
+        bench(
+            "HODL.main",
+            lambda: HODL(3, min(10, coins), 0.18).main(start),
+            lambda: shutil.rmtree(
+                os.path.join("./strategies", hodl.name), ignore_errors=True
+            ),
+        )
+
+        # Backtest stage
+        for engine in ["loop", "array"]:
+            krypfolio = Krypfolio(debug=False, engine=engine)
+            bench(
+                "Krypfolio.main[{}]".format(engine),
+                lambda: krypfolio.main(hodl.name, 0.12, 2, start, write=False),
+            )
+
+        losses = [round(float(l), 2) for l in np.arange(0.05, 0.36, 0.01)]
+        bench(
+            "hyperopt.search_batch",
+            lambda: hyperopt.search_batch([[hodl.name], [start], losses, range(1, 7)]),
+        )
+        bench(
+            "search.optimize[tpe]",
+            lambda: search.optimize(
+                search.Objective(start), search.TPESampler(seed=seed), budget=30
+            ),
+        )
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(workspace, ignore_errors=True)
+
+    return {
+        "commit": commit(),
+        "date": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "machine": platform.machine(),
+        "cpus": os.cpu_count(),
+        "size": {"coins": coins, "years": years, "seed": seed},
+        "results": results,
+    }
+
+
+def compare(before, after):
+    """
+    Print the median time and peak memory ratios of two result files
+    """
+
+    before = json.load(open(before, "r"))
+    after = json.load(open(after, "r"))
+    print("{:<28}{:>12}{:>12}{:>8}{:>10}".format("", "before", "after", "x", "memory"))
+    for name, new in after["results"].items():
+        old = before["results"].get(name)
+        if old is None:
+            print("{:<28}{:>12}{:>12.4f}".format(name, "-", new["median"]))
+            continue
+        memory = (
+            "{:.2f}".format(new["peak_mb"] / old["peak_mb"])
+            if old.get("peak_mb") and new.get("peak_mb")
+            else "-"
+        )
+        print(
+            "{:<28}{:>12.4f}{:>12.4f}{:>8.2f}{:>10}".format(
+                name,
+                old["median"],
+                new["median"],
+                new["median"] / old["median"],
+                memory,
+            )
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument("--coins", type=int, default=50)
+    parser.add_argument("--years", type=float, default=3)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--no-memory", action="store_true")
+    parser.add_argument("--output", default=None)
+    parser.add_argument("--compare", nargs=2, metavar=("BEFORE", "AFTER"))
+    args = parser.parse_args()
+
+    if args.compare:
+        compare(*args.compare)
+    else:
+        report = run(
+            args.coins,
+            args.years,
+            args.repeat,
+            not args.no_memory,
+            args.workers,
+            args.seed,
+        )
+        output = json.dumps(report, indent=4)
+        if args.output:
+            with open(args.output, "w") as f:
+                f.write(output)
+        print(output)
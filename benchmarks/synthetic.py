@@ -0,0 +1,92 @@
+import json
+import os
+from datetime import date, datetime, timedelta
+
+import numpy as np
+import pandas as pd
+from dateutil import rrule
+from scipy.signal import lfilter
+
+
+def coins(n):
+    return ["bitcoin"] + ["coin-{:03d}".format(k) for k in range(1, n)]
+
+
+def series(n_coins, years, seed=0):
+    """
+    Daily quotes of n_coins until today, bitcoin having the largest market
+    cap; the other coins are listed at random dates of the first year
+
+    Returns:
+        dict of coin -> DataFrame with the columns of the processed CSVs
+    """
+
+    rng = np.random.default_rng(seed)
+    end = pd.Timestamp(date.today())
+    days = pd.date_range(end - pd.Timedelta(days=int(365 * years)), end, freq="D")
+
+    data = dict()
+    for k, coin in enumerate(coins(n_coins)):
+        first = 0 if k == 0 else int(rng.integers(0, min(365, len(days) - 2)))
+        d = days[first:]
+        base = 3e11 if k == 0 else 10 ** rng.uniform(8, 10.8)
+        noise = rng.normal(0, 0.02 if k == 0 else 0.025, len(d))
+        market_cap = base * np.exp(lfilter([1.5], [1, -0.99], noise))  # AR(1)
+        close = market_cap / rng.uniform(1e5, 1e9)
+        data[coin] = pd.DataFrame(
+            {
+                "close": close,
+                "high": close * 1.01,
+                "low": close * 0.99,
+                "market_cap": market_cap,
+                "open": close * rng.uniform(0.98, 1.02, len(d)),
+                "timestamp": d.strftime("%Y-%m-%dT23:59:59.999Z"),
+                "volume": market_cap * rng.uniform(0.01, 0.2, len(d)),
+            }
+        )
+    return data
+
+
+def write_raw(data, folder="./data/raw"):
+    """
+    Write the quotes as monthly raw chunks, like vendor.download does
+    """
+
+    if not os.path.exists(folder):
+        os.makedirs(folder)
+    first = min(pd.Timestamp(df["timestamp"].iloc[0]) for df in data.values())
+    start = datetime(first.year, first.month, 1)
+    months = list(rrule.rrule(rrule.MONTHLY, dtstart=start, until=datetime.now()))
+    months.append(months[-1] + timedelta(days=31))
+    months[-1] = datetime(months[-1].year, months[-1].month, 1)
+
+    for coin, df in data.items():
+        times = pd.to_datetime(df["timestamp"]).dt.tz_localize(None)
+        for begin, end in zip(months[:-1], months[1:]):
+            rows = df[(times >= begin) & (times < end)]
+            if len(rows) == 0:
+                continue
+            quotes = [
+                {"time_close": row["timestamp"], "quote": {"USD": row}}
+                for row in rows.to_dict("records")
+            ]
+            path = os.path.join(
+                folder,
+                "{0}_{1}_{2}.json".format(
+                    coin, int(begin.timestamp()), int(end.timestamp())
+                ),
+            )
+            with open(path, "w") as f:
+                json.dump(
+                    {"status": {"error_code": 0}, "data": {"quotes": quotes}},
+                    f,
+                    indent=4,
+                    sort_keys=True,
+                )
+
+
+def write_processed(data, folder="./data/processed"):
+    if not os.path.exists(folder):
+        os.makedirs(folder)
+    for coin, df in data.items():
+        df.to_csv(os.path.join(folder, coin + ".csv"), index=False)
@@ -0,0 +1,200 @@
+import math
+from multiprocessing import Pool, cpu_count
+
+import numpy as np
+from tqdm.auto import tqdm
+
+import instrument
+from data import features, market
+
+# CUSUM settings, in standard deviations of the daily log returns
+threshold = 5.0
+drift = 0.5
+warmup = 30  # returns of a regime before it can change
+
+
+def cusum(dates, values, state=None):
+    """
+    Two-sided CUSUM of the daily log returns of a series, standardized by the
+    mean and deviation of the current regime: a change point is raised on
+    the day either sum exceeds the threshold, and a new regime starts
+
+    Only the observations the sums have seen are used, so a change point does
+    not depend on later data, and the scan can be resumed from its state.
+
+    Returns:
+        list of (day, direction) change points, 1 up and -1 down, and the
+        state to resume from: [pos, neg, n, mean, m2, last value]
+    """
+
+    if state is None:
+        state = [0.0, 0.0, 0, 0.0, 0.0, 0.0]
+    pos, neg, n, mean, m2, previous = state
+    n = int(n)
+    points = list()
+    for day, x in zip(dates, values):
+        if not x > 0:  # NaN or non-positive, no return
+            continue
+        if previous > 0:
+            ret = math.log(x / previous)
+            if n >= warmup:
+                std = math.sqrt(m2 / (n - 1))
+                z = (ret - mean) / std if std > 0 else 0.0
+                pos = max(0.0, pos + z - drift)
+                neg = max(0.0, neg - z - drift)
+                if pos > threshold or neg > threshold:
+                    points.append((day, 1 if pos > threshold else -1))
+                    pos, neg, n, mean, m2 = 0.0, 0.0, 0, 0.0, 0.0
+            # Welford's update of the regime mean and variance
+            n += 1
+            delta = ret - mean
+            mean += delta / n
+            m2 += delta * (ret - mean)
+        previous = x
+    return points, [float(pos), float(neg), n, float(mean), float(m2), float(previous)]
+
+
+def scan(args):
+    """
+    Change points of one coin, will be used in a process pool
+    """
+
+    dates, values, state = args
+    return cusum(dates.tolist(), values.tolist(), state)
+
+
+def detect(panel, feature="close", folder="./data/features", workers=None):
+    """
+    Change points of every coin of the panel, kept in
+    ./data/features/changepoints_{feature}.npz
+
+    The scan of a coin is resumed on the observations after its last date,
+    with its stored change points, as long as the values it was run on are
+    unchanged; otherwise the coin is scanned again from scratch. The coins
+    to scan are spread across a process pool.
+
+    Args:
+        panel: MarketPanel of the full history of the feature
+        feature: series to scan, close or market_cap
+        workers: number of processes, all cores by default
+
+    Returns:
+        dict of coin -> (days, directions) of its change points
+    """
+
+    name = "changepoints_{}".format(feature)
+    settings = [threshold, drift, warmup]
+    stored = features.read(name, folder)
+    if stored is not None and stored["settings"].tolist() != settings:
+        stored = None  # scanned with other settings
+
+    points = dict()
+    states = dict()
+    tasks = list()
+    for j, symbol in enumerate(panel.symbols):
+        values = panel.features[feature][:, j]
+        observed = ~np.isnan(values)
+        if not observed.any():
+            continue
+
+        state, begin = None, 0
+        if stored is not None and symbol in stored["symbols"]:
+            k = stored["symbols"].tolist().index(symbol)
+            last = stored["last"][k]
+            if features.digest(panel, feature, j, last) == stored["digest"][k]:
+                state = stored["state"][k].tolist()
+                begin = np.searchsorted(panel.dates, last, side="right")
+                mine = stored["point_symbol"] == k
+                points[symbol] = list(
+                    zip(
+                        stored["point_date"][mine].tolist(),
+                        stored["point_direction"][mine].tolist(),
+                    )
+                )
+
+        states[symbol] = state
+        rows = np.flatnonzero(observed[begin:]) + begin
+        if len(rows) > 0:
+            tasks.append((symbol, (panel.dates[rows], values[rows], state)))
+    instrument.count("coins_scanned", len(tasks))
+
+    workers = min(len(tasks), workers or cpu_count())
+    if workers > 1:
+        with Pool(workers) as p:
+            results = list(tqdm(p.imap(scan, [t for _, t in tasks]), total=len(tasks)))
+    else:
+        results = [scan(t) for _, t in tasks]
+
+    for (symbol, _), (new, state) in zip(tasks, results):
+        points[symbol] = points.get(symbol, list()) + new
+        states[symbol] = state
+        instrument.count("change_points", len(new))
+
+    if stored is None or len(tasks) > 0:
+        symbols = list(states)
+        columns = [panel.symbols.index(s) for s in symbols]
+        observed = ~np.isnan(panel.features[feature])
+        last = [panel.dates[observed[:, j]][-1] for j in columns]
+        flat = [(k, d, u) for k, s in enumerate(symbols) for d, u in points.get(s, [])]
+        features.write(
+            name,
+            {
+                "settings": np.array(settings),
+                "symbols": np.array(symbols, dtype=str),
+                "last": np.array(last, dtype="datetime64[D]"),
+                "digest": np.array(
+                    [
+                        features.digest(panel, feature, j, d)
+                        for j, d in zip(columns, last)
+                    ]
+                ),
+                "state": np.array([states[s] for s in symbols], dtype=float).reshape(
+                    len(symbols), 6
+                ),
+                "point_symbol": np.array([k for k, _, _ in flat], dtype=int),
+                "point_date": np.array([d for _, d, _ in flat], dtype="datetime64[D]"),
+                "point_direction": np.array([u for _, _, u in flat], dtype=int),
+            },
+            folder,
+        )
+
+    return {
+        symbol: (
+            np.array([d for d, _ in points.get(symbol, [])], dtype="datetime64[D]"),
+            np.array([u for _, u in points.get(symbol, [])], dtype=int),
+        )
+        for symbol in panel.symbols
+    }
+
+
+def regimes(panel, changepoints):
+    """
+    (dates x coins) direction of the latest change point of each coin on or
+    before each date, 0 before its first one
+    """
+
+    result = np.zeros((len(panel.dates), len(panel.symbols)), dtype=int)
+    for j, symbol in enumerate(panel.symbols):
+        days, directions = changepoints.get(symbol, (None, []))
+        if len(directions) == 0:
+            continue
+        i = np.searchsorted(days, panel.dates, side="right") - 1
+        result[:, j] = np.where(i >= 0, directions[i.clip(0)], 0)
+    return result
+
+
+@instrument.stage("changepoints")
+def update(columns=("close", "market_cap"), workers=None):
+    """
+    Scan the new observations of every coin of the market data for change
+    points, one cache per column
+    """
+
+    panel = market.load(list(columns))
+    return {ft: detect(panel, ft, workers=workers) for ft in columns}
+
+
+if __name__ == "__main__":
+    for ft, changepoints in update().items():
+        n = sum(len(directions) for _, directions in changepoints.values())
+        print("{0}: {1} change points over {2} coins".format(ft, n, len(changepoints)))
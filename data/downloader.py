@@ -0,0 +1,183 @@
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from functools import partial
+
+from requests import Session
+from requests.adapters import HTTPAdapter
+from requests.exceptions import ConnectionError, Timeout, TooManyRedirects
+
+import instrument
+
+
+class TokenBucket:
+    """
+    Rate limiter allowing rate requests per second on average, with bursts
+    of up to capacity requests
+    """
+
+    def __init__(self, rate, capacity=1, clock=time.monotonic):
+        self.rate = rate
+        self.capacity = capacity
+        self.clock = clock
+        self.tokens = capacity
+        self.updated = clock()
+        self.until = 0  # no request before this time, set by the server
+        self.lock = None
+
+    def _refill(self):
+        now = self.clock()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        return now
+
+    def pause(self, seconds):
+        """
+        Hold every request for the given number of seconds
+        """
+
+        self.until = max(self.until, self.clock() + seconds)
+        self.tokens = 0
+
+    async def acquire(self):
+        if self.lock is None:
+            self.lock = asyncio.Lock()
+        async with self.lock:
+            while True:
+                now = self._refill()
+                if now < self.until:
+                    await asyncio.sleep(self.until - now)
+                elif self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                else:
+                    await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+def retry_after(response):
+    """
+    Seconds to wait given by the Retry-After header of a response, if any
+    """
+
+    value = response.headers.get("Retry-After")
+    if value is None:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        when = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(0.0, (when - datetime.now(timezone.utc)).total_seconds())
+
+
+class Downloader:
+    """
+    Concurrent GET requests over one pooled session, within a rate limit
+
+    The blocking requests run on a thread pool driven by asyncio, at most
+    concurrency at a time. Connection errors, 429 and 5xx responses are
+    retried with exponential backoff; a 429 holds every request for its
+    Retry-After delay.
+    """
+
+    def __init__(
+        self,
+        rate=5,
+        burst=5,
+        concurrency=8,
+        retries=5,
+        backoff=1.0,
+        timeout=30,
+        headers=None,
+    ):
+        self.bucket = TokenBucket(rate, burst)
+        self.concurrency = concurrency
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+
+        self.session = Session()
+        self.session.headers.update(headers or dict())
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=concurrency)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.executor = ThreadPoolExecutor(concurrency)
+
+    async def get(self, url, params, semaphore):
+        """
+        JSON content of a GET request, None if it failed after the retries
+        """
+
+        loop = asyncio.get_event_loop()
+        request = partial(self.session.get, url, params=params, timeout=self.timeout)
+        error = None
+        for attempt in range(self.retries + 1):
+            delay = self.backoff * 2**attempt
+            async with semaphore:
+                await self.bucket.acquire()
+                instrument.count("http_requests")
+                try:
+                    response = await loop.run_in_executor(self.executor, request)
+                except (ConnectionError, Timeout, TooManyRedirects) as e:
+                    error = e
+                else:
+                    error = "HTTP {0} {1}".format(response.status_code, response.url)
+                    if response.status_code == 429:
+                        instrument.count("http_throttled")
+                        delay = retry_after(response) or delay
+                        self.bucket.pause(delay)
+                    elif response.status_code >= 500:
+                        delay = retry_after(response) or delay
+                    elif response.status_code >= 400:
+                        print(error)
+                        return None
+                    else:
+                        try:
+                            return response.json()
+                        except ValueError as e:
+                            error = e
+            if attempt < self.retries:
+                instrument.count("http_retries")
+                await asyncio.sleep(delay)
+        print(error)
+        instrument.count("http_failed")
+        return None
+
+    async def _fetch(self, requests, callback):
+        # asyncio primitives belong to the loop of this run
+        semaphore = asyncio.Semaphore(self.concurrency)
+        self.bucket.lock = asyncio.Lock()
+
+        async def fetch(i, url, params):
+            data = await self.get(url, params, semaphore)
+            if callback is not None:
+                callback(i, data)
+            return data
+
+        return await asyncio.gather(
+            *[fetch(i, url, params) for i, (url, params) in enumerate(requests)]
+        )
+
+    def fetch(self, requests, callback=None):
+        """
+        Run GET requests concurrently
+
+        Args:
+            requests: list of (url, params)
+            callback: called with the index and the JSON content of each
+                request as it completes
+
+        Returns:
+            list of JSON contents, None for the failed requests
+        """
+
+        return asyncio.run(self._fetch(requests, callback))
+
+    def close(self):
+        self.executor.shutdown()
+        self.session.close()
@@ -0,0 +1,122 @@
+import hashlib
+import os
+
+import numpy as np
+
+import instrument
+
+
+def _path(feature, folder):
+    return os.path.join(folder, "{}.npz".format(feature))
+
+
+def digest(panel, feature, j, last):
+    """
+    Fingerprint of the observations of a coin up to a date
+    """
+
+    values = panel.features[feature][:, j]
+    observed = ~np.isnan(values) & (panel.dates <= last)
+    h = hashlib.sha1(panel.dates[observed].astype("int64").tobytes())
+    h.update(values[observed].tobytes())
+    return h.hexdigest()
+
+
+def read(feature, folder="./data/features"):
+    """
+    Load a stored feature, None if it was never computed
+    """
+
+    path = _path(feature, folder)
+    if not os.path.exists(path):
+        return None
+    instrument.count("files_read")
+    with np.load(path) as f:
+        return {k: f[k] for k in f.files}
+
+
+def write(feature, data, folder="./data/features"):
+    if not os.path.exists(folder):
+        os.makedirs(folder)
+    path = _path(feature, folder)
+    with open(path + ".tmp", "wb") as f:
+        np.savez_compressed(f, **data)
+    os.replace(path + ".tmp", path)
+
+
+def ewma_market_cap(panel, alpha, folder="./data/features"):
+    """
+    EWMA market cap of every coin of the panel, aligned on its dates, kept
+    in ./data/features/ewma_market_cap_{alpha}_days.npz
+
+    The stored EWMA of a coin is reused, and resumed on the observations
+    after its last date, as long as the market caps it was computed on are
+    unchanged; otherwise the coin is computed again from scratch.
+    """
+
+    feature = "ewma_market_cap_{}_days".format(alpha)
+    stored = read(feature, folder)
+
+    state = dict()
+    if stored is not None:
+        symbols = stored["symbols"].tolist()
+        for j, symbol in enumerate(panel.symbols):
+            if symbol not in symbols:
+                continue
+            k = symbols.index(symbol)
+            last = stored["last"][k]
+            if np.isnat(last):
+                continue
+            if digest(panel, "market_cap", j, last) == stored["digest"][k]:
+                state[symbol] = [stored["weighted"][k], stored["old_wt"][k], str(last)]
+
+    values, new_state = panel.ewma("market_cap", alpha, state)
+
+    # The resumed coins keep their stored values up to their last date
+    if len(state) > 0:
+        rows = np.searchsorted(stored["dates"], panel.dates).clip(
+            0, len(stored["dates"]) - 1
+        )
+        found = stored["dates"][rows] == panel.dates
+        for j, symbol in enumerate(panel.symbols):
+            if symbol in state:
+                k = symbols.index(symbol)
+                before = found & (panel.dates <= stored["last"][k])
+                values[before, j] = stored["values"][rows[before], k]
+
+    changed = [s for s in new_state if s not in state or new_state[s] != state[s]]
+    if stored is None or len(changed) > 0:
+        last = np.array(
+            [new_state[s][2] if s in new_state else "NaT" for s in panel.symbols],
+            dtype="datetime64[D]",
+        )
+        write(
+            feature,
+            {
+                "dates": panel.dates,
+                "symbols": np.array(panel.symbols, dtype=str),
+                "values": values,
+                "weighted": np.array(
+                    [
+                        new_state[s][0] if s in new_state else np.nan
+                        for s in panel.symbols
+                    ]
+                ),
+                "old_wt": np.array(
+                    [new_state[s][1] if s in new_state else 1.0 for s in panel.symbols]
+                ),
+                "last": last,
+                "digest": np.array(
+                    [
+                        (
+                            digest(panel, "market_cap", j, last[j])
+                            if not np.isnat(last[j])
+                            else ""
+                        )
+                        for j in range(len(panel.symbols))
+                    ]
+                ),
+            },
+            folder,
+        )
+    return values
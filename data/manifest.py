@@ -0,0 +1,218 @@
+import glob
+import hashlib
+import json
+import os
+import sqlite3
+import time
+from datetime import datetime, timezone
+
+# A chunk is stale when its last quote is older than this before its end
+STALE = 26 * 3600
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS chunks (
+    coin TEXT NOT NULL,
+    start INTEGER NOT NULL,
+    end INTEGER NOT NULL,
+    path TEXT NOT NULL,
+    status TEXT NOT NULL DEFAULT 'pending',
+    checksum TEXT,
+    last_quote INTEGER,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    updated INTEGER,
+    PRIMARY KEY (coin, start, end)
+);
+CREATE TABLE IF NOT EXISTS consolidated (
+    coin TEXT PRIMARY KEY,
+    digest TEXT NOT NULL
+);
+"""
+
+
+def parse(path):
+    """
+    Coin, start and end timestamps of a raw data path
+    """
+
+    name = os.path.basename(path).replace(".json", "")
+    coin, start, end = name.split("_")
+    return coin, int(start), int(end)
+
+
+def last_quote(data):
+    """
+    Close time of the last quote of a downloaded chunk, as a Unix timestamp
+    """
+
+    quotes = data["data"]["quotes"]
+    if len(quotes) == 0:
+        return None
+    close = datetime.strptime(quotes[-1]["time_close"], "%Y-%m-%dT%H:%M:%S.%fZ")
+    return int(close.replace(tzinfo=timezone.utc).timestamp())
+
+
+def checksum(path):
+    with open(path, "rb") as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+
+class Manifest:
+    """
+    SQLite index of the raw data chunks: status, time range, checksum and
+    last quote of each, so planning a refresh is a query rather than a scan
+    of the raw files
+    """
+
+    def __init__(self, path="./data/raw/manifest.sqlite"):
+        self.path = path
+        self.db = sqlite3.connect(path)
+        self.db.executescript(SCHEMA)
+        self.db.commit()
+
+    def __len__(self):
+        return self.db.execute("SELECT COUNT(*) FROM chunks").fetchone()[0]
+
+    def index(self, pattern="./data/raw/*.json"):
+        """
+        Record the raw files downloaded before the manifest existed, once
+        """
+
+        if len(self) > 0:
+            return
+        for path in glob.glob(pattern):
+            try:
+                data = json.load(open(path, "r"))
+            except ValueError:
+                continue
+            if data["status"]["error_code"] == 0:
+                self.record(path, data)
+
+    def plan(self, paths, now=None):
+        """
+        Raw paths to download: the ones not downloaded yet, or the last chunk
+        of a coin when its last quote is stale
+        """
+
+        now = int(now if now is not None else time.time())
+        self.db.executemany(
+            "INSERT OR IGNORE INTO chunks (coin, start, end, path) VALUES (?, ?, ?, ?)",
+            [parse(path) + (path,) for path in paths],
+        )
+        self.db.execute("CREATE TEMP TABLE IF NOT EXISTS wanted (path TEXT)")
+        self.db.execute("DELETE FROM wanted")
+        self.db.executemany("INSERT INTO wanted VALUES (?)", [(p,) for p in paths])
+        self.db.commit()
+
+        rows = self.db.execute(
+            """
+            SELECT c.path FROM chunks c JOIN wanted w ON c.path = w.path
+            WHERE c.status != 'done'
+            OR (
+                c.start = (SELECT MAX(start) FROM chunks WHERE coin = c.coin)
+                AND c.start <= ?
+                AND (c.last_quote IS NULL OR MIN(?, c.end) - c.last_quote > ?)
+            )
+            ORDER BY c.coin, c.start
+            """,
+            (now, now, STALE),
+        )
+        return [row[0] for row in rows]
+
+    def record(self, path, data):
+        """
+        Record the outcome of a download, data being None if it failed
+
+        A failed refresh of a done chunk whose file is still on disk only
+        counts the attempt: the chunk keeps its status and checksum, so its
+        data stays in the processed CSV.
+        """
+
+        coin, start, end = parse(path)
+        if data is None:
+            self.db.execute(
+                """
+                INSERT INTO chunks (coin, start, end, path, status, attempts, updated)
+                VALUES (?, ?, ?, ?, 'failed', 1, ?)
+                ON CONFLICT (coin, start, end) DO UPDATE SET
+                    status = CASE
+                        WHEN status = 'done' AND ? THEN status ELSE 'failed'
+                    END,
+                    attempts = attempts + 1,
+                    updated = ?
+                """,
+                (
+                    coin,
+                    start,
+                    end,
+                    path,
+                    int(time.time()),
+                    os.path.exists(path),
+                    int(time.time()),
+                ),
+            )
+        else:
+            self.db.execute(
+                """
+                INSERT OR REPLACE INTO chunks (
+                    coin, start, end, path, status, checksum, last_quote,
+                    attempts, updated
+                )
+                VALUES (?, ?, ?, ?, 'done', ?, ?, 0, ?)
+                """,
+                (
+                    coin,
+                    start,
+                    end,
+                    path,
+                    checksum(path),
+                    last_quote(data),
+                    int(time.time()),
+                ),
+            )
+        self.db.commit()
+
+    def chunks(self, coin=None):
+        """
+        Downloaded chunks as (coin, start, end, path, checksum), by coin and
+        start
+        """
+
+        query = (
+            "SELECT coin, start, end, path, checksum FROM chunks WHERE status = 'done'"
+        )
+        if coin is None:
+            return self.db.execute(query + " ORDER BY coin, start").fetchall()
+        return self.db.execute(
+            query + " AND coin = ? ORDER BY start", (coin,)
+        ).fetchall()
+
+    def digest(self, coin):
+        """
+        Raw chunks a coin was last consolidated from, as a list of (start,
+        checksum, rows written) in start order, rows being -1 when the rows
+        were sorted afterwards
+        """
+
+        row = self.db.execute(
+            "SELECT digest FROM consolidated WHERE coin = ?", (coin,)
+        ).fetchone()
+        if row is None:
+            return list()
+        try:
+            return [
+                (int(start), sha1, int(rows))
+                for start, sha1, rows in (c.split(":") for c in row[0].split())
+            ]
+        except ValueError:  # digest of an older manifest
+            return list()
+
+    def consolidated(self, coin, chunks):
+        digest = " ".join("{0}:{1}:{2}".format(*c) for c in chunks)
+        self.db.execute(
+            "INSERT OR REPLACE INTO consolidated (coin, digest) VALUES (?, ?)",
+            (coin, digest),
+        )
+        self.db.commit()
+
+    def close(self):
+        self.db.close()
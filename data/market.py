@@ -0,0 +1,172 @@
+import json
+import os
+import shutil
+
+import numpy as np
+
+import instrument
+from data.panel import MarketPanel, to_day
+
+# Columns of the processed CSVs, besides the timestamp
+COLUMNS = ["close", "high", "low", "market_cap", "open", "volume"]
+
+
+class MarketStore:
+    """
+    Market data of all coins in one columnar store, partitioned by year
+
+    Each ./data/market/{year}/ partition holds the days of the year in
+    dates.npy and one (days x coins) array per column in {column}.npy,
+    missing observations being NaN. index.json lists the coins in column
+    order; new coins are appended, so older partitions may have fewer
+    columns. Reads only load the requested columns and partitions, as
+    memory maps by default.
+    """
+
+    def __init__(self, path="./data/market"):
+        self.path = path
+
+    def exists(self):
+        return os.path.exists(os.path.join(self.path, "index.json"))
+
+    def index(self):
+        with open(os.path.join(self.path, "index.json"), "r") as f:
+            return json.load(f)
+
+    def _partitions(self, start=None, end=None):
+        years = sorted(int(name) for name in os.listdir(self.path) if name.isdigit())
+        if start is not None:
+            years = [y for y in years if y >= to_day(start).astype(object).year]
+        if end is not None:
+            years = [y for y in years if y <= to_day(end).astype(object).year]
+        return [os.path.join(self.path, str(y)) for y in years]
+
+    def read(self, columns=COLUMNS, start=None, end=None, mmap=True):
+        """
+        Load columns between two dates, both included, as a MarketPanel
+        """
+
+        symbols = self.index()["symbols"]
+        mode = "r" if mmap else None
+
+        dates = list()
+        matrices = {col: list() for col in columns}
+        for part in self._partitions(start, end):
+            instrument.count("files_read", 1 + len(columns))
+            days = np.load(os.path.join(part, "dates.npy"))
+            i = np.searchsorted(days, to_day(start)) if start is not None else 0
+            j = (
+                np.searchsorted(days, to_day(end), side="right")
+                if end is not None
+                else len(days)
+            )
+            dates.append(days[i:j])
+            for col in columns:
+                values = np.load(os.path.join(part, col + ".npy"), mmap_mode=mode)
+                values = values[i:j]
+                if values.shape[1] < len(symbols):  # coins added later
+                    values = np.pad(
+                        values,
+                        ((0, 0), (0, len(symbols) - values.shape[1])),
+                        constant_values=np.nan,
+                    )
+                matrices[col].append(values)
+
+        if len(dates) == 1:  # a view of the memory map, no copy
+            return MarketPanel(
+                dates[0], symbols, {col: v[0] for col, v in matrices.items()}
+            )
+        if len(dates) == 0:
+            return MarketPanel(
+                np.array([], dtype="datetime64[D]"),
+                symbols,
+                {col: np.empty((0, len(symbols))) for col in columns},
+            )
+        return MarketPanel(
+            np.concatenate(dates),
+            symbols,
+            {col: np.concatenate(v) for col, v in matrices.items()},
+        )
+
+    def write(self, panel):
+        """
+        Replace the store with the given panel
+        """
+
+        tmp = self.path + ".tmp"
+        shutil.rmtree(tmp, ignore_errors=True)
+        os.makedirs(tmp)
+
+        years = panel.dates.astype("datetime64[Y]")
+        for year in np.unique(years):
+            rows = years == year
+            part = os.path.join(tmp, str(year))
+            os.makedirs(part)
+            np.save(os.path.join(part, "dates.npy"), panel.dates[rows])
+            for col, values in panel.features.items():
+                np.save(os.path.join(part, col + ".npy"), values[rows])
+        with open(os.path.join(tmp, "index.json"), "w") as f:
+            json.dump(
+                {"symbols": list(panel.symbols), "columns": list(panel.features)}, f
+            )
+
+        if os.path.exists(self.path):
+            os.replace(self.path, self.path + ".old")
+        os.replace(tmp, self.path)
+        shutil.rmtree(self.path + ".old", ignore_errors=True)
+
+    def import_csv(self, coins=None, folder="./data/processed"):
+        """
+        Build the store from the processed CSVs, or only update the given
+        coins of an existing store
+        """
+
+        if coins is None or not self.exists():
+            self.write(MarketPanel.from_csv(COLUMNS, os.path.join(folder, "*.csv")))
+            return
+        if len(coins) == 0:
+            return  # nothing changed, the store is left as it is
+
+        paths = [os.path.join(folder, coin + ".csv") for coin in coins]
+        new = MarketPanel.from_csv(COLUMNS, [p for p in paths if os.path.exists(p)])
+        old = self.read(mmap=False)
+
+        symbols = old.symbols + [s for s in new.symbols if s not in old.symbols]
+        dates = np.union1d(old.dates, new.dates)
+        old_rows = np.searchsorted(dates, old.dates)
+        new_rows = np.searchsorted(dates, new.dates)
+        new_columns = [symbols.index(s) for s in new.symbols]
+        replaced = [symbols.index(s) for s in coins if s in symbols]
+
+        features = dict()
+        for col in COLUMNS:
+            values = np.full((len(dates), len(symbols)), np.nan)
+            values[old_rows, : len(old.symbols)] = old.features[col]
+            values[:, replaced] = np.nan  # coins without a CSV anymore stay empty
+            values[np.ix_(new_rows, new_columns)] = new.features[col]
+            features[col] = values
+        self.write(MarketPanel(dates, symbols, features))
+
+
+def load(features, start=None, end=None, path="./data/market"):
+    """
+    Load features into a MarketPanel, from the market store if it was
+    built, else from the processed CSVs
+    """
+
+    store = MarketStore(path)
+    if store.exists():
+        return store.read(features, start, end)
+    panel = MarketPanel.from_csv(features)
+    if start is not None or end is not None:
+        keep = np.ones(len(panel.dates), dtype=bool)
+        if start is not None:
+            keep &= panel.dates >= to_day(start)
+        if end is not None:
+            keep &= panel.dates <= to_day(end)
+        panel = MarketPanel(
+            panel.dates[keep],
+            panel.symbols,
+            {ft: v[keep] for ft, v in panel.features.items()},
+        )
+    return panel
@@ -0,0 +1,217 @@
+import glob
+import json
+import ntpath
+import os
+import traceback
+
+import numpy as np
+import pandas as pd
+
+import instrument
+
+
+def to_day(dt):
+    """
+    Convert a date-like value to numpy day precision
+    """
+
+    return pd.Timestamp(dt).to_datetime64().astype("datetime64[D]")
+
+
+class MarketPanel:
+    """
+    Dates x coins matrices of market features, loaded once and indexed by date
+
+    Missing observations are stored as NaN.
+    """
+
+    def __init__(self, dates, symbols, features):
+        self.dates = dates  # sorted np.ndarray of datetime64[D]
+        self.symbols = symbols  # list of coin names, column order
+        self.features = features  # dict of feature -> (dates x coins) array
+
+    @classmethod
+    def from_csv(cls, features, pattern="./data/processed/*.csv"):
+        """
+        Load the given features of every processed CSV into one panel, the
+        CSVs being given by a glob pattern or a list of paths
+        """
+
+        paths = sorted(glob.glob(pattern)) if isinstance(pattern, str) else pattern
+        instrument.count("files_read", len(paths))
+        frames = dict()
+        for path in paths:
+            try:
+                df = pd.read_csv(path, usecols=["timestamp"] + list(features))
+                days = pd.to_datetime(df["timestamp"].values).tz_localize(None)
+                days = days.values.astype("datetime64[D]")
+                # keep the first row of a day, like the per-date lookup did
+                days, first = np.unique(days, return_index=True)
+                frames[ntpath.basename(path).replace(".csv", "")] = (
+                    days,
+                    df.iloc[first],
+                )
+            except Exception as e:
+                traceback.print_tb(e.__traceback__)
+                continue
+
+        symbols = list(frames.keys())
+        if len(frames) > 0:
+            dates = np.unique(np.concatenate([days for days, _ in frames.values()]))
+        else:
+            dates = np.array([], dtype="datetime64[D]")
+
+        matrices = {ft: np.full((len(dates), len(symbols)), np.nan) for ft in features}
+        for j, symbol in enumerate(symbols):
+            days, df = frames[symbol]
+            rows = np.searchsorted(dates, days)
+            for ft in features:
+                matrices[ft][rows, j] = df[ft].values
+        return cls(dates, symbols, matrices)
+
+    @classmethod
+    def open(cls, path, features=None):
+        """
+        Open a panel written by save as read-only memory maps, shared with
+        no copy by every process opening it
+        """
+
+        with open(os.path.join(path, "index.json"), "r") as f:
+            index = json.load(f)
+        return cls(
+            np.array(index["dates"], dtype="datetime64[D]"),
+            index["symbols"],
+            {
+                ft: np.load(os.path.join(path, ft + ".npy"), mmap_mode="r")
+                for ft in (features or index["features"])
+            },
+        )
+
+    def save(self, path):
+        """
+        Write one .npy file per feature, with an index.json sidecar of the
+        dates and symbols
+        """
+
+        if not os.path.exists(path):
+            os.makedirs(path)
+        for ft, values in self.features.items():
+            np.save(os.path.join(path, ft + ".npy"), np.asarray(values, dtype=float))
+        index = {
+            "dates": [str(d) for d in self.dates],
+            "symbols": list(self.symbols),
+            "features": list(self.features),
+        }
+        with open(os.path.join(path, "index.json.tmp"), "w") as f:
+            json.dump(index, f)
+        os.replace(
+            os.path.join(path, "index.json.tmp"), os.path.join(path, "index.json")
+        )
+
+    def has(self, features):
+        return all(ft in self.features for ft in features)
+
+    def row(self, dt):
+        """
+        Row index of a date, None if the date is not in the panel
+        """
+
+        day = to_day(dt)
+        i = np.searchsorted(self.dates, day)
+        if i < len(self.dates) and self.dates[i] == day:
+            return i
+        return None
+
+    def valid(self, features):
+        """
+        Mask of cells where every feature is observed and non-zero
+        """
+
+        mask = np.ones((len(self.dates), len(self.symbols)), dtype=bool)
+        for ft in features:
+            values = self.features[ft]
+            mask &= ~np.isnan(values) & (values != 0)
+        return mask
+
+    def at(self, dt, features):
+        """
+        Coins observed at a given date, as a list of dicts
+        """
+
+        i = self.row(dt)
+        if i is None:
+            return list()
+
+        values = [self.features[ft][i] for ft in features]
+        mask = np.ones(len(self.symbols), dtype=bool)
+        for v in values:
+            mask &= ~np.isnan(v) & (v != 0)
+
+        data = list()
+        for j in np.flatnonzero(mask):
+            tmp = {"name": self.symbols[j]}
+            for ft, v in zip(features, values):
+                tmp[ft] = v[j]
+            data.append(tmp)
+        return data
+
+    def ewma(self, feature, halflife, state=None):
+        """
+        Time-based exponentially weighted moving average of a feature,
+        matching pandas ewm(halflife="{halflife} days", times=...).mean()
+
+        The recursion can be resumed from the state of a previous run, in
+        which case only the observations after each coin's last processed
+        date are computed; earlier cells are left as NaN.
+
+        Returns the (dates x coins) EWMA matrix and the state to resume from:
+        dict of coin -> [weighted average, total weight, last date].
+        """
+
+        state = state or dict()
+        n = len(self.symbols)
+        weighted = np.full(n, np.nan)
+        old_wt = np.ones(n)
+        last = np.full(n, np.datetime64("NaT"), dtype="datetime64[D]")
+        for j, symbol in enumerate(self.symbols):
+            if symbol in state:
+                weighted[j], old_wt[j] = state[symbol][0], state[symbol][1]
+                last[j] = np.datetime64(state[symbol][2], "D")
+
+        values = self.features[feature]
+        result = np.full(values.shape, np.nan)
+        if n == 0:
+            return result, state
+
+        # Resume from the earliest date any coin still needs
+        begin = 0
+        if not np.isnat(last).any():
+            begin = np.searchsorted(self.dates, last.min(), side="right")
+
+        for i in range(begin, len(self.dates)):
+            x = values[i]
+            observed = ~np.isnan(x) & ~(self.dates[i] <= last)
+            first = observed & np.isnan(weighted)
+            update = observed & ~np.isnan(weighted)
+
+            deltas = (self.dates[i] - last[update]).astype(np.float64) / halflife
+            old_wt[update] *= 0.5**deltas
+            changed = update & (weighted != x)
+            weighted[changed] = (old_wt[changed] * weighted[changed] + x[changed]) / (
+                old_wt[changed] + 1.0
+            )
+            old_wt[update] += 1.0
+
+            weighted[first] = x[first]
+            old_wt[first] = 1.0
+            last[observed] = self.dates[i]
+            result[i, observed] = weighted[observed]
+
+        state = dict(state)
+        for j in np.flatnonzero(~np.isnat(last)):
+            state[self.symbols[j]] = [
+                float(weighted[j]),
+                float(old_wt[j]),
+                str(last[j]),
+            ]
+        return result, state
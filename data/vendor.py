@@ -1,20 +1,26 @@
+import csv
 import glob
+import itertools
 import json
 import os
-import time
 from datetime import date, datetime, timedelta
-from multiprocessing.dummy import Pool as ThreadPool
-from random import randrange
+from multiprocessing import Pool, cpu_count
 
 import numpy as np
 import pandas as pd
 from dateutil import rrule
 from requests import Session
 from requests.exceptions import ConnectionError, Timeout, TooManyRedirects
-from scipy import stats
-from sklearn.neighbors import LocalOutlierFactor
 from tqdm.auto import tqdm
 
+import instrument
+from data import changepoints
+from data.downloader import Downloader
+from data.manifest import Manifest, parse
+from data.market import MarketStore
+
+ohlcv_url = "https://web-api.coinmarketcap.com/v1/cryptocurrency/ohlcv/historical"
+
 # Default headers for Coinmarketcap
 headers = {
     "accept": "application/json, text/plain, */*",
@@ -31,6 +37,7 @@ def get(url, parameters, headers):
     session = Session()
     session.headers.update(headers)
 
+    instrument.count("http_requests")
     try:
         data = session.get(url, params=parameters).json()
         return data
@@ -39,69 +46,322 @@ def get(url, parameters, headers):
         return None
 
 
-def download(path):
+def save(path, data):
     """
-    Data downloading utility, will be used in multithread
+    Write the downloaded data of a raw data path, if it is valid
     """
 
-    # Parse coin, start, end from path
-    coin, start, end = path.replace("./data/raw/", "").replace(".json", "").split("_")
-
-    data = get(
-        "https://web-api.coinmarketcap.com/v1/cryptocurrency/ohlcv/historical",
-        parameters={
-            "convert": "USD",
-            "slug": coin,
-            "time_end": str(int(end)),
-            "time_start": str(int(start)),
-        },
-        headers=headers,
-    )
-
+    if data is None:
+        return False
     if data["status"]["error_code"] == 0:
         json.dump(
             data,
-            open("./data/raw/{0}_{1}_{2}.json".format(coin, int(start), int(end)), "w"),
+            open(path, "w"),
             indent=4,
             sort_keys=True,
             default=str,
         )
-    else:
-        print(data["status"])
+        instrument.count("files_written")
+        return True
+    print(data["status"])
+    return False
+
+
+def download(paths, downloader=None, manifest=None):
+    """
+    Data downloading utility, fetching the raw data paths concurrently
+    within the API rate limit, and recording each outcome in the manifest
+    """
+
+    requests = list()
+    for path in paths:
+        coin, start, end = parse(path)
+        requests.append(
+            (
+                ohlcv_url,
+                {
+                    "convert": "USD",
+                    "slug": coin,
+                    "time_end": str(end),
+                    "time_start": str(start),
+                },
+            )
+        )
+
+    own = downloader is None
+    downloader = downloader or Downloader(headers=headers)
+    with tqdm(total=len(paths)) as progress:
+
+        def done(i, data):
+            saved = save(paths[i], data)
+            if manifest is not None:
+                manifest.record(paths[i], data if saved else None)
+            progress.update()
+
+        downloader.fetch(requests, callback=done)
+    if own:
+        downloader.close()
+
+
+def lof_inliers(market_cap):
+    """
+    Inliers of the market cap history by Local Outlier Factor
+    """
+
+    from sklearn.neighbors import LocalOutlierFactor
+
+    X = market_cap.reshape(-1, 1)
+    y = LocalOutlierFactor(
+        n_neighbors=9, metric="manhattan", contamination=0.02
+    ).fit_predict(X)
+    return y == 1
+
+
+def mad_inliers(market_cap, window=31, threshold=6, floor=0.01):
+    """
+    Inliers of the market cap history by rolling median and median absolute
+    deviation (MAD): a day is an outlier when it is more than threshold
+    scaled MADs away from the median of the window around it
+
+    Linear in the history, and a day only depends on its window, unlike the
+    LOF fit over the whole history. The MAD is at least floor times the
+    median, so a window of mostly repeated quotes, whose MAD is 0, does not
+    make every move an outlier.
+    """
+
+    x = pd.Series(market_cap, dtype=float)
+    median = x.rolling(window, center=True, min_periods=1).median()
+    deviation = (x - median).abs()
+    mad = deviation.rolling(window, center=True, min_periods=1).median()
+    mad = np.maximum(mad, floor * median.abs())
+    return (deviation <= threshold * 1.4826 * mad).values
 
-    time.sleep(randrange(10))
 
+detectors = {"lof": lof_inliers, "mad": mad_inliers}
 
-def clean():
+
+def clean_file(args):
+    """
+    Remove the outliers of a consolidated CSV into its processed CSV, will be
+    used in a process pool
+    """
+
+    source, path, method = args
+    df = pd.read_csv(source)
+
+    if len(df) > 1:
+        df = df.iloc[np.where(detectors[method](df["market_cap"].values))]
+
+        df = df[df["market_cap"] > 0]
+
+        df.drop_duplicates(inplace=True)
+
+        df = df[["close", "high", "low", "market_cap", "open", "timestamp", "volume"]]
+        df.to_csv(path, index=False)
+    elif os.path.exists(path):
+        os.remove(path)
+
+
+def clean(coins=None, method="lof", workers=None):
     """
     Utility to clean and remove outlier
+
+    The processed CSV of a coin is written from its consolidated CSV, which
+    is left as downloaded, so cleaning again with another detector does not
+    remove the outliers twice.
+
+    Args:
+        coins: coins to clean, the ones whose data changed, all by default
+        method: outlier detector, "lof" or "mad"
+        workers: number of processes, all cores by default
+    """
+
+    if coins is None:
+        sources = glob.glob("./data/consolidated/*.csv")
+    else:
+        sources = [f"./data/consolidated/{coin}.csv" for coin in coins]
+        sources = [source for source in sources if os.path.exists(source)]
+
+    if len(sources) == 0:
+        return
+    if not os.path.exists("./data/processed"):
+        os.mkdir("./data/processed")
+    tasks = [
+        (source, os.path.join("./data/processed", os.path.basename(source)), method)
+        for source in sources
+    ]
+    instrument.count("files_read", len(tasks))
+    instrument.count("files_written", len(tasks))
+    with Pool(min(len(tasks), workers or cpu_count())) as p:
+        _ = list(tqdm(p.imap_unordered(clean_file, tasks), total=len(tasks)))
+
+
+def outlier_report(paths=None, output="./data/outliers.csv"):
     """
+    Rows of the processed CSVs each detector would remove, for comparison
 
-    for path in glob.glob("./data/processed/*.csv"):
+    Returns:
+        DataFrame of the rows removed by at least one detector, with a
+        boolean column per detector
+    """
+
+    report = list()
+    for path in paths or sorted(glob.glob("./data/processed/*.csv")):
         df = pd.read_csv(path)
+        if len(df) <= 1:
+            continue
+        removed = {m: ~f(df["market_cap"].values) for m, f in detectors.items()}
+        any_removed = np.logical_or.reduce(list(removed.values()))
+        rows = df.loc[any_removed, ["timestamp", "market_cap"]]
+        rows.insert(0, "coin", os.path.basename(path).replace(".csv", ""))
+        for m, r in removed.items():
+            rows[m] = r[any_removed]
+        report.append(rows)
+
+    report = (
+        pd.concat(report, ignore_index=True)
+        if report
+        else pd.DataFrame(columns=["coin", "timestamp", "market_cap"] + list(detectors))
+    )
+    if output is not None:
+        report.to_csv(output, index=False)
+    return report
+
 
-        if len(df) > 1:
-            X = df["market_cap"].values.reshape(-1, 1)
-            y = LocalOutlierFactor(
-                n_neighbors=9, metric="manhattan", contamination=0.02
-            ).fit_predict(X)
-            inlier_index = np.where(y == 1)
-            df = df.iloc[inlier_index]
+def quotes(path):
+    """
+    Daily quotes of a raw data file, in timestamp order
+    """
 
-            del X, y, inlier_index
+    instrument.count("files_read")
+    content = json.load(open(path))
+    return [x["quote"]["USD"] for x in content["data"]["quotes"]]
 
-            df = df[df["market_cap"] > 0]
 
-            df.drop_duplicates(inplace=True)
+def consolidate(coins, manifest, force=False):
+    """
+    Write the consolidated CSV of each coin from its raw chunks, streaming the
+    chunks in time order, for the coins whose chunks changed since the last
+    consolidation, or all of them if force
+
+    The rows of the chunks before the first changed one are kept as they are,
+    so refreshing the last month of a coin only parses that month again.
+
+    Returns:
+        list of the consolidated coins
+    """
 
-            df = df[
-                ["close", "high", "low", "market_cap", "open", "timestamp", "volume"]
-            ]
-            df.to_csv(path, index=False)
+    if not os.path.exists("./data/consolidated"):
+        os.mkdir("./data/consolidated")
+
+    coins = set(coins) if coins is not None else None
+    changed = list()
+    for coin, chunks in itertools.groupby(manifest.chunks(), key=lambda x: x[0]):
+        if coins is not None and coin not in coins:
+            continue
+        chunks = list(chunks)
+        path = f"./data/consolidated/{coin}.csv"
+        done = manifest.digest(coin) if not force and os.path.exists(path) else []
+
+        # First chunk that changed since the last consolidation
+        i = 0
+        while i < min(len(chunks), len(done)) and done[i][:2] == (
+            chunks[i][1],
+            chunks[i][4],
+        ):
+            i += 1
+        if i == len(chunks) == len(done):
+            continue
+        if any(rows < 0 for _, _, rows in done[:i]):
+            i = 0  # sorted rows do not follow the chunks, write them all again
+
+        # Monthly chunks are sorted and do not overlap, so writing them in
+        # start order keeps the rows sorted; otherwise sort once at the end
+        ordered = True
+        last = None
+        written = [rows for _, _, rows in done[:i]]
+        with open(path + ".tmp", "w", newline="") as f:
+            writer = None
+            if i > 0:
+                with open(path, "r", newline="") as old:
+                    lines = list(itertools.islice(old, sum(written) + 1))
+                f.writelines(lines)
+                header = next(csv.reader(lines[:1]))
+                writer = csv.DictWriter(f, header, extrasaction="ignore")
+                if len(lines) > 1:
+                    last = next(csv.DictReader([lines[0], lines[-1]]))["timestamp"]
+            for _, _, _, raw, _ in chunks[i:]:
+                rows = 0
+                for row in quotes(raw):
+                    if writer is None:
+                        writer = csv.DictWriter(f, list(row), extrasaction="ignore")
+                        writer.writeheader()
+                    if last is not None and row["timestamp"] < last:
+                        ordered = False
+                    last = row["timestamp"]
+                    writer.writerow(row)
+                    rows += 1
+                written.append(rows)
+        if last is None:  # no quotes at all
+            os.remove(path + ".tmp")
+            if os.path.exists(path):
+                os.remove(path)
         else:
-            os.remove(path)
+            if not ordered:
+                data = pd.read_csv(path + ".tmp")
+                data.sort_values(by="timestamp", inplace=True)
+                data.to_csv(path + ".tmp", index=False)
+                written = [-1] * len(chunks)
+            os.replace(path + ".tmp", path)
+
+        manifest.consolidated(
+            coin, [(c[1], c[4], rows) for c, rows in zip(chunks, written)]
+        )
+        instrument.count("files_written")
+        changed.append(coin)
+    return changed
+
+
+@instrument.stage("reprocess")
+def reprocess(coins=None, method="lof", workers=None):
+    """
+    Clean coins again with another detector, from their consolidated CSVs,
+    so the outliers are removed from the downloaded data once, however many
+    times this is run
+
+    Args:
+        coins: coins to clean, all the downloaded ones by default
+        method: outlier detector, "lof" or "mad"
+        workers: number of processes, all cores by default
+
+    Returns:
+        list of the cleaned coins, empty when none of them was downloaded
+    """
+
+    if not os.path.exists("./data/raw"):
+        return list()
+    manifest = Manifest()
+    manifest.index()
+    downloaded = sorted({chunk[0] for chunk in manifest.chunks()})
+    coins = [c for c in downloaded if coins is None or c in coins]
+    if len(coins) == 0:
+        manifest.close()
+        return coins
+    with instrument.stage("consolidate"):
+        consolidate(coins, manifest)
+    manifest.close()
+
+    with instrument.stage("clean"):
+        clean(coins, method, workers)
 
+    with instrument.stage("market_store"):
+        MarketStore().import_csv(coins)
 
+    changepoints.update()
+    return coins
+
+
+@instrument.stage("market_info")
 def market_info():
     """
     1. Get top 150 coins from Coinmarketcap
@@ -109,19 +369,20 @@ def market_info():
     """
 
     # Top 150 coins by market cap
-    top_coins = get(
-        "https://web-api.coinmarketcap.com/v1/cryptocurrency/listings/latest",
-        parameters={
-            "aux": "circulating_supply,max_supply,total_supply",
-            "convert": "USD",
-            "cryptocurrency_type": "coins",
-            "limit": "150",
-            "sort": "market_cap",
-            "sort_dir": "desc",
-            "start": "1",
-        },
-        headers=headers,
-    )
+    with instrument.stage("listing"):
+        top_coins = get(
+            "https://web-api.coinmarketcap.com/v1/cryptocurrency/listings/latest",
+            parameters={
+                "aux": "circulating_supply,max_supply,total_supply",
+                "convert": "USD",
+                "cryptocurrency_type": "coins",
+                "limit": "150",
+                "sort": "market_cap",
+                "sort_dir": "desc",
+                "start": "1",
+            },
+            headers=headers,
+        )
 
     top_coins = [x["slug"] for x in top_coins["data"]]
 
@@ -149,53 +410,29 @@ def market_info():
                 "./data/raw/{0}_{1}_{2}.json".format(coin, time_start, time_end)
             )
 
-    existing_data = glob.glob("./data/raw/*.json")
-    to_download = list(set(all_data) - set(existing_data))
+    # Missing, failed or stale chunks, from the manifest
+    with instrument.stage("plan"):
+        manifest = Manifest()
+        manifest.index()
+        to_download = manifest.plan(all_data)
 
-    if len(to_download) != 0:
-        pass
-    else:  # compare the status timestamp and latest quote timestamp
-        re_download = list()
-        for coin in top_coins:
-            latest_file = existing_data.copy()
-            latest_file = sorted(
-                [x for x in latest_file if coin + "_" in x], reverse=True
-            )[0]
-            latest_quote = json.load(open(latest_file, "r"))
-            now = datetime.utcnow()
-            quote_ts = datetime.strptime(
-                latest_quote["data"]["quotes"][-1]["time_close"],
-                "%Y-%m-%dT%H:%M:%S.%fZ",
-            )
+    with instrument.stage("download"):
+        download(to_download, manifest=manifest)
+
+    # Consolidate data
+    with instrument.stage("consolidate"):
+        changed = consolidate(top_coins, manifest)
+    instrument.count("coins_changed", len(changed))
 
-            if (now - quote_ts).total_seconds() // 3600 > 26:
-                re_download.append(latest_file)
-        to_download = re_download
+    with instrument.stage("clean"):
+        clean(changed)  # remove bad data, of the coins with new rows
 
-    # Use multithread download
-    with ThreadPool(32) as p:
-        _ = list(tqdm(p.imap(download, to_download), total=len(to_download)))
+    # Update the market store from the cleaned CSVs
+    with instrument.stage("market_store"):
+        MarketStore().import_csv(changed)
 
-    # Consolidate data
-    existing_data = glob.glob("./data/raw/*.json")
-
-    for coin in top_coins:
-        to_consolidate = [
-            x
-            for x in existing_data
-            if coin == x.replace("./data/raw/", "").replace(".json", "").split("_")[0]
-        ]
-        data = list()
-        for path in to_consolidate:
-            content = json.load(open(path))
-            content = [x["quote"]["USD"] for x in content["data"]["quotes"]]
-            data.append(content)
-        data = sum(data, [])
-        data = pd.DataFrame(data)
-        data.sort_values(by="timestamp", inplace=True)
-        data.to_csv(f"./data/processed/{coin}.csv", index=False)
-
-    clean()  # remove bad data
+    # Scan the new rows for change points, the other coins are cached
+    changepoints.update()
 
 
 if __name__ == "__main__":
@@ -1,19 +1,21 @@
-import json
 import os
 import sys
-from datetime import date, datetime
+from datetime import datetime
 
 import numpy as np
 import pandas as pd
-from dateutil import rrule
 
-from config import *
+import instrument
+from execution import engine, metrics
+from strategies import store
 
 
 class Krypfolio:
-    def __init__(self, debug=True) -> None:
+    def __init__(self, debug=True, fmt="npz", engine="loop") -> None:
         super().__init__()
         self.debug = debug
+        self.fmt = fmt  # format of the allocation dumps, "npz" or "json"
+        self.engine = engine  # "loop" over dicts, or "array" (execution.engine)
 
     def _print(self, msg):
         if self.debug:
@@ -68,38 +70,7 @@ class Krypfolio:
         self._print("Current portfolio's balance: {}".format(int(balance_)))
 
         # Inject investment in three stages
-        fund = 0
-        injection = None
-        if investment > 0:
-            if len(prices) >= 3:
-                a, b, c = prices[-2], prices[-1], price_
-                if a <= b and b <= c:
-                    fund = investment
-                    injection = "Third"
-                if (a <= b and b >= c and a <= c) or (a >= b and b <= c and a <= c):
-                    fund = 0.25 * investment
-                    injection = "Second"
-                if a >= b and b <= c and a >= c:
-                    fund = 0.20 * investment
-                    injection = "First"
-                if (a >= b and b >= c) or (a <= b and b >= c and a >= c):
-                    fund = 0
-                    injection = None
-            elif len(prices) == 2:
-                a, b = prices[-1], price_
-                if a <= b:
-                    fund = 0.25 * investment
-                    injection = "Second"
-                else:
-                    fund = 0
-                    injection = None
-            else:
-                fund = 0.20 * investment
-                injection = "First"
-
-            if balance_ == 0:
-                fund = 0.20 * investment
-                injection = "First"
+        fund, injection = engine.inject(prices, price_, balance_, investment)
 
         balance_ += fund
 
@@ -112,61 +83,25 @@ class Krypfolio:
         )
         return allocation, investment - fund
 
-    def main(self, strategy, loss, r, start):
+    def walk(self, allocations, intervals, loss, investment):
         """
-        Args:
-            strategy: strategy name
-            loss: trailing loss percentage
-            r: rebalance period in week
-            start: start date
+        Walk through the daily allocations, rebalancing at the intervals
         """
 
-        # Initial invesment
-        investment = 10000
-        init_investment = investment
-
-        # Start date
-        start = datetime.strptime(start, "%Y-%m-%d")
-        today = date.today()
-
-        intervals = list(rrule.rrule(rrule.WEEKLY, dtstart=start, until=today))
-        intervals = [
-            intervals[i] for i in range(len(intervals)) if i % r == 0
-        ]  # rebalance after each r weeks
-
-        # Portfolios should follow the same structure
-        # List(Dict(symbol, price, ratio, market_cap, amount))
-        allocations = json.load(open(f"strategies/{strategy}.json", "r"))
-        allocations = [
-            {
-                "timestamp": datetime.strptime(k, "%Y-%m-%d"),
-                "allocations": allocations[k],
-            }
-            for k in allocations.keys()
-        ]
-        allocations = [
-            alloc
-            for alloc in allocations
-            if "bitcoin" in [x["symbol"] for x in alloc["allocations"]]
-        ]  # bitcoin must be in valid allocation
-
         krypfolio = allocations[0]
         for alloc in krypfolio["allocations"]:
             alloc["amount"] = 0  # init amount
 
-        # Prepare the folder for results
-        if not os.path.exists("./execution/results"):
-            os.mkdir("./execution/results")
-
         # Rebalance the portfolio
         start_btc = None
         start_date = None
         balance_ = None
-        end_balance_ = None
         max_balance = -np.inf
         prices = list()
         kf_fund = list()
         kf_allocation = dict()
+        rebalances = 0
+        stop_losses = 0
         for alloc in allocations:
             if alloc["timestamp"] in intervals:
                 total_ratio = sum([x["ratio"] for x in alloc["allocations"]])
@@ -180,6 +115,7 @@ class Krypfolio:
                     krypfolio, investment = self.rebalance(
                         krypfolio, prices, alloc, investment
                     )
+                    rebalances += 1
                     balance_ = self.balance(krypfolio)
                     self._print(
                         "Current total value: {}".format(int(balance_ + investment))
@@ -197,6 +133,7 @@ class Krypfolio:
                     ):
                         # Reset the portfolio
                         self._print("STOP LOSS")
+                        stop_losses += 1
                         for alloc_ in krypfolio["allocations"]:
                             alloc_["amount"] = 0
                         investment += balance_
@@ -231,48 +168,172 @@ class Krypfolio:
                         alloc_["amount"] = 0
                     investment += balance_
                     max_balance = -np.inf
+                    stop_losses += 1
+        instrument.count("rebalances", rebalances)
+        instrument.count("stop_losses", stop_losses)
 
-        end_date = allocations[-1]["timestamp"]
         end_btc = [
             x["close"]
             for x in allocations[-1]["allocations"]
             if x["symbol"] == "bitcoin"
         ][0]
-        end_balance_ = investment + balance_
+        return {
+            "timestamp": [x[0] for x in kf_fund],
+            "value": [x[1] for x in kf_fund],
+            "start_date": start_date,
+            "start_btc": start_btc,
+            "end_date": allocations[-1]["timestamp"],
+            "end_btc": end_btc,
+            "end_balance": investment + balance_,
+            "allocations": kf_allocation,
+        }
+
+    @instrument.stage("Krypfolio.main")
+    def main(self, strategy, loss, r, start, write=True):
+        """
+        Args:
+            strategy: strategy name
+            loss: trailing loss percentage
+            r: rebalance period in week
+            start: start date
+            write: write the results to ./execution/results
+
+        Returns:
+            daily value of the portfolio, indexed by date
+        """
+
+        # Initial invesment
+        investment = 10000
+        init_investment = investment
+
+        # Start date
+        start = datetime.strptime(start, "%Y-%m-%d")
+        intervals = engine.rebalance_dates(start, r)
+
+        # Portfolios should follow the same structure
+        # List(Dict(symbol, price, ratio, market_cap, amount))
+        with instrument.stage("load"):
+            table = store.load(strategy)
+        if self.engine == "array":
+            matrix = engine.AllocationMatrix.from_table(table).having("bitcoin")
+            with instrument.stage("simulate"):
+                result = engine.simulate(
+                    matrix, loss, matrix.mask(intervals), investment
+                )
+        else:
+            allocations = store.records(table)
+            allocations = [
+                alloc
+                for alloc in allocations
+                if "bitcoin" in [x["symbol"] for x in alloc["allocations"]]
+            ]  # bitcoin must be in valid allocation
+            with instrument.stage("walk"):
+                result = self.walk(allocations, intervals, loss, investment)
+
         self._print("*********************************")
         self._print("REPORT")
-        self._print("Start date: {}".format(start_date))
-        self._print("End date: {}".format(end_date))
-        self._print("Bitcoin: {}x".format(round(end_btc / start_btc, 1)))
-        self._print("Krypfolio: {}x".format(round(end_balance_ / init_investment, 1)))
+        self._print("Start date: {}".format(result["start_date"]))
+        self._print("End date: {}".format(result["end_date"]))
+        self._print(
+            "Bitcoin: {}x".format(round(result["end_btc"] / result["start_btc"], 1))
+        )
+        self._print(
+            "Krypfolio: {}x".format(round(result["end_balance"] / init_investment, 1))
+        )
         self._print("*********************************")
 
-        # Write Krypfolio daily results to csv
-        df = pd.DataFrame(kf_fund, columns=["timestamp", "value"])
-        df.to_csv(
-            "./execution/results/{0}_{1}_{2}_{3}.csv".format(
-                strategy, start.strftime("%Y-%m-%d"), loss, r
-            ),
-            index=False,
+        df = pd.DataFrame(
+            {"timestamp": result["timestamp"], "value": result["value"]},
+            columns=["timestamp", "value"],
         )
+        if write:
+            # Prepare the folder for results
+            if not os.path.exists("./execution/results"):
+                os.mkdir("./execution/results")
 
-        if self.debug:
-            # Write Krypfolio daily allocations to json
-            json.dump(
-                kf_allocation,
-                open(
-                    "./execution/results/{0}_{1}_{2}_{3}.json".format(
+            # Write Krypfolio daily results to csv
+            df.to_csv(
+                "./execution/results/{0}_{1}_{2}_{3}.csv".format(
+                    strategy, start.strftime("%Y-%m-%d"), loss, r
+                ),
+                index=False,
+            )
+
+            if self.debug and "allocations" in result:
+                # Write Krypfolio daily allocations
+                store.write(
+                    "./execution/results/{0}_{1}_{2}_{3}".format(
                         strategy, start.strftime("%Y-%m-%d"), loss, r
                     ),
-                    "w",
-                ),
-                indent=4,
-                sort_keys=True,
-                default=str,
+                    result["allocations"],
+                    fmt=self.fmt,
+                )
+        return pd.Series(
+            df["value"].values, index=pd.DatetimeIndex(df["timestamp"]), name="value"
+        )
+
+    @instrument.stage("Krypfolio.compare")
+    def compare(self, strategies, loss, r, start, investment=10000):
+        """
+        Backtest many strategies at once, with the same rules as main: their
+        allocations are loaded once, aligned on shared dates and symbols, and
+        simulated together in one pass
+
+        Args:
+            strategies: strategy names
+            loss: trailing loss percentage
+            r: rebalance period in week
+            start: start date
+            investment: initial investment
+
+        Returns:
+            DataFrame of the metrics of each strategy, the best Sharpe first
+        """
+
+        start = datetime.strptime(start, "%Y-%m-%d")
+        with instrument.stage("load"):
+            stack = engine.AllocationStack.from_matrices(
+                {
+                    strategy: engine.AllocationMatrix.from_table(
+                        store.load(strategy)
+                    ).having("bitcoin")
+                    for strategy in strategies
+                }
             )
+        with instrument.stage("simulate"):
+            values = engine.simulate_stack(
+                stack,
+                np.arange(len(stack.names)),
+                np.full(len(stack.names), loss),
+                stack.mask(engine.rebalance_dates(start, r)),
+                investment,
+            )
+
+        observed = ~np.isnan(values)
+        found = observed.any(axis=1)
+        first = observed.argmax(axis=1)
+        last = values.shape[1] - 1 - observed[:, ::-1].argmax(axis=1)
+        rows = np.arange(len(values))
+        btc = np.where(
+            stack.order == stack.symbols.index("bitcoin"), stack.close, 0
+        ).sum(axis=2)
+        table = pd.DataFrame(
+            {
+                "strategy": stack.names,
+                "start_date": np.where(found, stack.dates[first], np.datetime64("NaT")),
+                "end_date": np.where(found, stack.dates[last], np.datetime64("NaT")),
+                "multiple": np.where(found, values[rows, last] / investment, np.nan),
+                "bitcoin": np.where(found, btc[rows, last] / btc[rows, first], np.nan),
+                **metrics.summary(values),
+            }
+        )
+        self._print(table.to_string(index=False))
+        return table.sort_values("sharpe", ascending=False, ignore_index=True)
 
 
 if __name__ == "__main__":
+    from config import *
+
     krypfolio = Krypfolio(debug=True)
     krypfolio.main(
         strategy="HODL{0}-{1}-days-{2}-cap".format(n_coins, alpha, str(int(100 * cap))),
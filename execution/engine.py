@@ -0,0 +1,492 @@
+from datetime import date, datetime
+
+import numpy as np
+from dateutil import rrule
+
+import instrument
+
+
+def rebalance_dates(start, r):
+    """
+    Rebalance after each r weeks from the start date until today
+    """
+
+    today = date.today()
+    intervals = list(rrule.rrule(rrule.WEEKLY, dtstart=start, until=today))
+    return [intervals[i] for i in range(len(intervals)) if i % r == 0]
+
+
+def inject(prices, price_, balance_, investment):
+    """
+    Amount of the leftover investment to inject in three stages, based on
+    the last portfolio prices
+    """
+
+    fund = 0
+    injection = None
+    if investment > 0:
+        if len(prices) >= 3:
+            a, b, c = prices[-2], prices[-1], price_
+            if a <= b and b <= c:
+                fund = investment
+                injection = "Third"
+            if (a <= b and b >= c and a <= c) or (a >= b and b <= c and a <= c):
+                fund = 0.25 * investment
+                injection = "Second"
+            if a >= b and b <= c and a >= c:
+                fund = 0.20 * investment
+                injection = "First"
+            if (a >= b and b >= c) or (a <= b and b >= c and a >= c):
+                fund = 0
+                injection = None
+        elif len(prices) == 2:
+            a, b = prices[-1], price_
+            if a <= b:
+                fund = 0.25 * investment
+                injection = "Second"
+            else:
+                fund = 0
+                injection = None
+        else:
+            fund = 0.20 * investment
+            injection = "First"
+
+        if balance_ == 0:
+            fund = 0.20 * investment
+            injection = "First"
+    return fund, injection
+
+
+def inject_batch(n_prices, a, b, c, balance_, investment):
+    """
+    inject over arrays of combinations: n_prices past prices of which a and b
+    are the last two, c the current price
+    """
+
+    fund = np.zeros(len(investment))
+    three = n_prices >= 3
+    fund = np.where(three & (a <= b) & (b <= c), investment, fund)
+    fund = np.where(
+        three & (((a <= b) & (b >= c) & (a <= c)) | ((a >= b) & (b <= c) & (a <= c))),
+        0.25 * investment,
+        fund,
+    )
+    fund = np.where(three & (a >= b) & (b <= c) & (a >= c), 0.20 * investment, fund)
+    fund = np.where(
+        three & (((a >= b) & (b >= c)) | ((a <= b) & (b >= c) & (a >= c))), 0, fund
+    )
+    fund = np.where((n_prices == 2) & (b <= c), 0.25 * investment, fund)
+    fund = np.where(n_prices < 2, 0.20 * investment, fund)
+    fund = np.where(balance_ == 0, 0.20 * investment, fund)
+    return np.where(investment > 0, fund, 0)
+
+
+def _sum(values):
+    """
+    Left to right sum, the same rounding as the builtin sum
+    """
+
+    return float(np.cumsum(values)[-1]) if len(values) > 0 else 0
+
+
+class AllocationMatrix:
+    """
+    Daily allocations aligned on a fixed symbol universe
+
+    ratio and close are (dates x symbols) arrays, NaN where a coin is not in
+    the allocation of a date; order holds the columns of each allocation in
+    their original order, padded, with counts the number of coins per date.
+    """
+
+    def __init__(self, dates, symbols, ratio, close, order, counts):
+        self.dates = dates
+        self.symbols = symbols
+        self.ratio = ratio
+        self.close = close
+        self.order = order
+        self.counts = counts
+
+    @classmethod
+    def from_table(cls, table):
+        """
+        Build the matrix from a columnar allocation table (see strategies.store)
+        """
+
+        dates, first, rows = np.unique(
+            table["date"], return_index=True, return_inverse=True
+        )
+        symbols, columns = np.unique(table["symbol"], return_inverse=True)
+
+        # Rank of each row within its date, rows of a date being contiguous
+        rank = np.arange(len(rows)) - first[rows]
+        counts = np.bincount(rows, minlength=len(dates))
+
+        ratio = np.full((len(dates), len(symbols)), np.nan)
+        close = np.full((len(dates), len(symbols)), np.nan)
+        ratio[rows, columns] = table["ratio"]
+        close[rows, columns] = table["close"]
+        order = np.zeros((len(dates), counts.max() if len(dates) else 0), dtype=int)
+        order[rows, rank] = columns
+        return cls(dates, symbols.tolist(), ratio, close, order, counts)
+
+    def take(self, keep):
+        """
+        Keep the dates selected by a boolean mask or an index array
+        """
+
+        return AllocationMatrix(
+            self.dates[keep],
+            self.symbols,
+            self.ratio[keep],
+            self.close[keep],
+            self.order[keep],
+            self.counts[keep],
+        )
+
+    def having(self, symbol):
+        """
+        Keep the dates whose allocation contains the symbol
+        """
+
+        if symbol not in self.symbols:
+            return self.take(np.zeros(len(self.dates), dtype=bool))
+        return self.take(~np.isnan(self.ratio[:, self.symbols.index(symbol)]))
+
+    def head(self, fraction):
+        """
+        Keep the first fraction of the dates, at least two
+        """
+
+        n = max(2, int(round(fraction * len(self.dates))))
+        return self.take(slice(0, n))
+
+    def mask(self, intervals):
+        """
+        Boolean mask of the dates that are in the given datetimes
+        """
+
+        return np.isin(self.dates, np.array(intervals, dtype="datetime64[D]"))
+
+    def columns(self, i):
+        return self.order[i, : self.counts[i]]
+
+
+class AllocationStack:
+    """
+    Allocations of several strategies aligned on shared dates and symbols
+
+    order, weights and close are (strategies x dates x width) columns, ratios
+    and prices of each allocation in its original order, padded with column
+    len(symbols) at a zero weight and price; counts is the number of coins of
+    each allocation, 0 on the dates a strategy does not have. A strategy can
+    as well be a simulated path of prices (see execution.robustness).
+    """
+
+    def __init__(self, names, dates, symbols, order, weights, close, counts):
+        self.names = names
+        self.dates = dates
+        self.symbols = symbols
+        self.order = order
+        self.weights = weights
+        self.close = close
+        self.counts = counts
+
+    @classmethod
+    def from_matrices(cls, matrices):
+        """
+        Align AllocationMatrix objects, given as a dict of name -> matrix
+        """
+
+        names = list(matrices)
+        dates = np.unique(np.concatenate([m.dates for m in matrices.values()]))
+        symbols = sorted(set(s for m in matrices.values() for s in m.symbols))
+        n = len(symbols)
+        width = max([m.order.shape[1] for m in matrices.values()] + [0])
+
+        order = np.full((len(names), len(dates), width), n)
+        weights = np.zeros((len(names), len(dates), width))
+        close = np.zeros((len(names), len(dates), width))
+        counts = np.zeros((len(names), len(dates)), dtype=int)
+        for k, m in enumerate(matrices.values()):
+            rows = np.searchsorted(dates, m.dates)
+            columns = np.searchsorted(symbols, m.symbols)
+            w = m.order.shape[1]
+
+            padded = np.arange(w) >= m.counts[:, None]
+            ratio = np.take_along_axis(m.ratio, m.order, axis=1)
+            price = np.take_along_axis(m.close, m.order, axis=1)
+            order[k, rows, :w] = np.where(padded, n, columns[m.order])
+            weights[k, rows, :w] = np.where(padded, 0, ratio)
+            close[k, rows, :w] = np.where(padded, 0, price)
+            counts[k, rows] = m.counts
+        return cls(names, dates, symbols, order, weights, close, counts)
+
+    def take(self, keep):
+        """
+        Keep the dates selected by a boolean mask, an index array or a slice
+        """
+
+        return AllocationStack(
+            self.names,
+            self.dates[keep],
+            self.symbols,
+            self.order[:, keep],
+            self.weights[:, keep],
+            self.close[:, keep],
+            self.counts[:, keep],
+        )
+
+    def mask(self, intervals):
+        """
+        (strategies x dates) boolean mask of the dates that are in the given
+        datetimes, for the strategies that have them
+        """
+
+        found = np.isin(self.dates, np.array(intervals, dtype="datetime64[D]"))
+        return found & (self.counts > 0)
+
+
+def simulate(matrix, loss, rebalance, investment=10000):
+    """
+    Backtest with holdings, prices and ratios as arrays, same rules as
+    Krypfolio.main: stop loss, three-stage injection and rebalance on the
+    dates of the rebalance mask
+
+    Sums follow the allocation order so results match the dict-based loop
+    exactly.
+    """
+
+    btc = matrix.symbols.index("bitcoin")
+
+    # Portfolio columns in allocation order, with their last known prices
+    held = matrix.columns(0)
+    held_close = matrix.close[0, held].copy()
+    held_amount = np.zeros(len(held))
+
+    start_btc = None
+    start_date = None
+    balance_ = None
+    max_balance = -np.inf
+    prices = list()
+    kept = list()
+    values = list()
+    stop_losses = 0
+    for i in range(len(matrix.dates)):
+        close = matrix.close[i]
+        if rebalance[i]:
+            columns = matrix.columns(i)
+            ratios = matrix.ratio[i, columns]
+            if np.abs(_sum(ratios) - 1) > 0.001:  # check the validity
+                continue
+
+            # Update price of coins in the portfolio
+            held_close = np.where(np.isnan(close[held]), held_close, close[held])
+            balance_ = _sum(held_close * held_amount)
+            new_close = close[columns]
+            price_ = _sum(new_close * ratios)
+
+            fund, _ = inject(prices, price_, balance_, investment)
+            balance_ += fund
+            investment = investment - fund
+
+            held = columns
+            held_close = new_close
+            held_amount = ratios * balance_ / new_close
+            balance_ = _sum(held_close * held_amount)
+            kept.append(i)
+            values.append(balance_ + investment)
+            prices.append(price_)
+            if balance_ > max_balance:
+                max_balance = balance_
+            if ((max_balance - balance_) / max_balance > loss) and (balance_ != 0):
+                held_amount = np.zeros(len(held))
+                investment += balance_
+                max_balance = -np.inf
+                stop_losses += 1
+            if not start_btc:
+                start_btc = float(close[btc])
+                start_date = matrix.dates[i]
+        else:  # daily alloc, no ratio was calculated
+            held_close = np.where(np.isnan(close[held]), held_close, close[held])
+            balance_ = _sum(held_close * held_amount)
+            kept.append(i)
+            values.append(balance_ + investment)
+            if balance_ > max_balance:
+                max_balance = balance_ + 0.001
+            if ((max_balance - balance_) / max_balance > loss) and (balance_ != 0):
+                held_amount = np.zeros(len(held))
+                investment += balance_
+                max_balance = -np.inf
+                stop_losses += 1
+    instrument.count("rebalances", len(prices))
+    instrument.count("stop_losses", stop_losses)
+
+    def to_datetime(day):
+        return datetime.combine(day.astype(object), datetime.min.time())
+
+    return {
+        "timestamp": matrix.dates[kept].astype("datetime64[ns]"),
+        "value": np.array(values),
+        "start_date": to_datetime(start_date) if start_date is not None else None,
+        "start_btc": start_btc,
+        "end_date": to_datetime(matrix.dates[-1]),
+        "end_btc": float(matrix.close[-1, btc]),
+        "end_balance": investment + balance_,
+    }
+
+
+def simulate_stack(stack, strategy, losses, rebalance, investment=10000, active=None):
+    """
+    simulate for many combinations of many strategies at once, one state row
+    per combination
+
+    Args:
+        stack: AllocationStack
+        strategy: (combinations,) index of the strategy of each combination
+        losses: (combinations,) trailing loss percentages
+        rebalance: (combinations x dates) rebalance masks
+        investment: initial investment
+        active: (combinations x dates) dates each combination trades on,
+            all the dates of its strategy by default
+
+    Returns:
+        (combinations x dates) values of the portfolios, NaN where simulate
+        records nothing (dates the strategy does not have or inactive, or
+        invalid allocation on a rebalance date)
+    """
+
+    strategy = np.asarray(strategy, dtype=int)
+    losses = np.asarray(losses, dtype=float)
+    rebalance = np.asarray(rebalance, dtype=bool)
+    k, n = len(losses), len(stack.symbols)
+    width = stack.order.shape[2]
+
+    # Validity and price of every allocation, which only depend on the
+    # strategy; cumsum adds left to right, the same rounding as _sum
+    present = stack.counts[strategy] > 0
+    if active is not None:
+        present &= active
+    valid = np.abs(np.cumsum(stack.weights, axis=2)[..., -1] - 1) <= 0.001
+    update = present & ~rebalance  # daily price update, no rebalance
+    rebalance = present & rebalance & valid[strategy]
+    new_close = stack.close
+    price = np.cumsum(new_close * stack.weights, axis=2)[..., -1]
+    observed = np.arange(width) < stack.counts[..., None]
+
+    # Holdings in allocation order, padded with the zero-priced column n, as
+    # flat indices into the last known prices of each strategy
+    last_close = np.zeros((len(stack.names), n + 1))
+    flat = last_close.reshape(-1)
+    offset = strategy[:, None] * (n + 1)
+    held = offset + np.full((k, width), n)
+    amount = np.zeros((k, width))
+
+    investment = np.full(k, float(investment))
+    max_balance = np.full(k, -np.inf)
+    n_prices = np.zeros(k, dtype=int)
+    a = np.zeros(k)  # second to last price
+    b = np.zeros(k)  # last price
+    values = np.full((k, len(stack.dates)), np.nan)
+    stop_losses = 0
+    for i in range(len(stack.dates)):
+        s, j = np.nonzero(observed[:, i])
+        last_close[s, stack.order[s, i, j]] = new_close[s, i, j]
+
+        # Update price of coins in the portfolios
+        balance_ = np.cumsum(flat[held] * amount, axis=1)[:, -1]
+
+        daily = update[:, i]
+        r = rebalance[:, i]
+        if r.any():
+            s = strategy[r]
+            price_ = price[s, i]
+
+            fund = inject_batch(
+                n_prices[r], a[r], b[r], price_, balance_[r], investment[r]
+            )
+            investment[r] -= fund
+            held[r] = offset[r] + stack.order[s, i]
+            with np.errstate(invalid="ignore", divide="ignore"):
+                amount[r] = np.where(
+                    observed[s, i],
+                    stack.weights[s, i]
+                    * (balance_[r] + fund)[:, None]
+                    / new_close[s, i],
+                    0,
+                )
+            balance_[r] = np.cumsum(flat[held[r]] * amount[r], axis=1)[:, -1]
+
+            a[r], b[r] = b[r], price_
+            n_prices[r] += 1
+            max_balance[r] = np.where(
+                balance_[r] > max_balance[r], balance_[r], max_balance[r]
+            )
+
+        max_balance[daily] = np.where(
+            balance_[daily] > max_balance[daily],
+            balance_[daily] + 0.001,
+            max_balance[daily],
+        )
+
+        recorded = r | daily
+        values[recorded, i] = balance_[recorded] + investment[recorded]
+
+        with np.errstate(invalid="ignore", divide="ignore"):
+            stop = (
+                recorded
+                & ((max_balance - balance_) / max_balance > losses)
+                & (balance_ != 0)
+            )
+        amount[stop] = 0
+        investment[stop] += balance_[stop]
+        max_balance[stop] = -np.inf
+        stop_losses += stop.sum()
+    instrument.count("simulations", k)
+    instrument.count("rebalances", n_prices.sum())
+    instrument.count("stop_losses", stop_losses)
+    return values
+
+
+def simulate_batch(matrix, losses, rebalance, investment=10000):
+    """
+    simulate for many combinations of one strategy at once, see
+    simulate_stack
+
+    Args:
+        matrix: AllocationMatrix
+        losses: (combinations,) trailing loss percentages
+        rebalance: (combinations x dates) rebalance masks
+        investment: initial investment
+
+    Returns:
+        (combinations x dates) values of the portfolios, NaN where simulate
+        records nothing (invalid allocation on a rebalance date)
+    """
+
+    stack = AllocationStack.from_matrices({"": matrix})
+    losses = np.asarray(losses, dtype=float)
+    return simulate_stack(
+        stack, np.zeros(len(losses), dtype=int), losses, rebalance, investment
+    )
+
+
+def simulate_grid(matrix, losses, rs, start, investment=10000):
+    """
+    simulate_batch over the product of stop losses and rebalance periods
+    from a start date
+
+    Returns:
+        list of (loss, r) combinations and their (combinations x dates) values
+    """
+
+    combinations = [(loss, r) for loss in losses for r in rs]
+    masks = {r: matrix.mask(rebalance_dates(start, r)) for r in rs}
+    values = simulate_batch(
+        matrix,
+        [loss for loss, _ in combinations],
+        np.array([masks[r] for _, r in combinations]).reshape(
+            len(combinations), len(matrix.dates)
+        ),
+        investment,
+    )
+    return combinations, values
@@ -1,29 +1,51 @@
 import itertools
+import multiprocessing
 import warnings
+from datetime import datetime
+from multiprocessing import Pool
 
 import numpy as np
 import pandas as pd
-import quantstats as qs
 from tqdm.auto import tqdm
 
-from config import *
+import instrument
+from execution import engine, metrics
 from execution.backtest import Krypfolio
+from execution.search import PoolObjective, TPESampler, optimize
+from strategies import store
+from strategies.hodl import HODL
 
 warnings.filterwarnings("ignore")
 
+# Allocations of the searched strategies, loaded once and shared read-only
+# with the workers
+_matrices = dict()
+_stack = None
 
-def analysis(path, mode):
+
+def to_returns(df):
     """
-    Utility to calculate Sharpe and Sortio ratio / full report
+    Daily returns of a Krypfolio value series
     """
 
-    returns = pd.read_csv(path)
+    returns = df.copy()
     returns["timestamp"] = pd.to_datetime(returns["timestamp"])
     returns.columns = ["Date", "Return"]
     returns.set_index("Date", inplace=True)
     returns = returns.iloc[:, 0].pct_change()
     returns = returns.replace([np.inf, -np.inf], np.nan)
-    returns = returns.fillna(method="bfill")
+    returns = returns.bfill()
+    return returns
+
+
+def analysis(path, mode):
+    """
+    Utility to calculate Sharpe and Sortio ratio / full report
+    """
+
+    import quantstats as qs  # slow to import, only needed for the report
+
+    returns = to_returns(pd.read_csv(path))
 
     if mode == "stats":
         return qs.stats.sharpe(returns)
@@ -35,27 +57,269 @@ def analysis(path, mode):
         )
 
 
-if __name__ == "__main__":
-    # Grid search for best hyper-parameters
-    _strategy = ["HODL{0}-{1}-days-{2}-cap".format(n_coins, alpha, str(int(100 * cap)))]
-    _start = [start]
-    _loss = [round(l, 2) for l in np.arange(0.05, 0.36, 0.01)]
-    _r = np.arange(1, 7, 1)
+def load(strategies):
+    """
+    Load the allocations of each strategy as an AllocationMatrix
+    """
+
+    return {
+        strategy: engine.AllocationMatrix.from_table(store.load(strategy)).having(
+            "bitcoin"
+        )
+        for strategy in strategies
+    }
+
+
+def _init(matrices):
+    global _matrices
+    _matrices = matrices
 
-    args = [_strategy, _start, _loss, _r]
 
-    # Instantiate Krypfolio backtest class
-    krypfolio = Krypfolio(debug=False)
+def evaluate(arg):
+    """
+    Backtest one (strategy, start, loss, r) combination in memory
+    """
+
+    strategy, start, loss, r = arg
+    matrix = _matrices[strategy]
+    intervals = engine.rebalance_dates(datetime.strptime(start, "%Y-%m-%d"), r)
+    result = engine.simulate(matrix, loss, matrix.mask(intervals))
+    return dict(
+        strategy=strategy,
+        start=start,
+        loss=loss,
+        r=r,
+        equity=pd.Series(result["value"], index=result["timestamp"], name="value"),
+        **metrics.summary(result["value"])
+    )
+
+
+@instrument.stage("search")
+def search(args, workers=None):
+    """
+    Grid search over the product of args across a process pool
+
+    Args:
+        args: [strategies, starts, losses, rs]
+        workers: number of processes, all cores by default
+    """
+
+    combinations = list(itertools.product(*args))
+    matrices = load(args[0])
+    workers = workers or multiprocessing.cpu_count()
+    instrument.count("simulations", len(combinations))
+
+    # With fork, the workers inherit the loaded matrices without a copy
+    with Pool(workers, initializer=_init, initargs=(matrices,)) as p:
+        chunksize = max(1, len(combinations) // (4 * workers))
+        return list(
+            tqdm(
+                p.imap(evaluate, combinations, chunksize=chunksize),
+                total=len(combinations),
+            )
+        )
+
+
+@instrument.stage("search_batch")
+def search_batch(args):
+    """
+    Grid search with one batched simulation per (strategy, start), all the
+    (loss, r) combinations being simulated together
+
+    Args:
+        args: [strategies, starts, losses, rs]
+    """
+
+    _strategy, _start, _loss, _r = args
+    matrices = load(_strategy)
 
     stats = list()
-    for arg in tqdm(list(itertools.product(*args))):
-        krypfolio.main(strategy=arg[0], start=arg[1], loss=arg[2], r=arg[3])
-        path = "./execution/results/{0}_{1}_{2}_{3}.csv".format(
-            arg[0], arg[1], arg[2], arg[3]
+    for strategy, start in itertools.product(_strategy, _start):
+        matrix = matrices[strategy]
+        combinations, values = engine.simulate_grid(
+            matrix, _loss, _r, datetime.strptime(start, "%Y-%m-%d")
+        )
+        summary = metrics.summary(values)
+        dates = pd.DatetimeIndex(matrix.dates.astype("datetime64[ns]"))
+        for i, (loss, r) in enumerate(combinations):
+            stats.append(
+                dict(
+                    strategy=strategy,
+                    start=start,
+                    loss=loss,
+                    r=r,
+                    equity=pd.Series(values[i], index=dates, name="value").dropna(),
+                    **{k: v[i] for k, v in summary.items()}
+                )
+            )
+    return stats
+
+
+def windows(dates, start=None, train=365, test=90, step=90):
+    """
+    Rolling walk-forward windows over sorted days, from the start date or
+    the first day: train days in sample followed by test days out of sample,
+    every step days
+
+    Returns:
+        list of (train start, test start, test end) days, the end excluded
+    """
+
+    train, test, step = [np.timedelta64(int(x), "D") for x in (train, test, step)]
+    if len(dates) == 0:
+        return list()
+    begin = dates[0] if start is None else max(dates[0], np.datetime64(start, "D"))
+    result = list()
+    while begin + train + test <= dates[-1] + np.timedelta64(1, "D"):
+        result.append((begin, begin + train, begin + train + test))
+        begin += step
+    return result
+
+
+def _init_stack(stack):
+    global _stack
+    _stack = stack
+
+
+def _walk(combinations):
+    """
+    In-sample and out-of-sample metrics of (strategy, train start, test
+    start, test end, loss, r) combinations, in one batched simulation
+    """
+
+    strategy, begin, middle, end, losses, rs = [np.array(x) for x in zip(*combinations)]
+
+    # Only simulate the dates of the windows of the chunk
+    stack = _stack.take(
+        slice(
+            np.searchsorted(_stack.dates, begin.min()),
+            np.searchsorted(_stack.dates, end.max()),
         )
-        stats.append([path, analysis(path, "stats")])
+    )
+    dates = stack.dates
+    in_sample = (dates >= begin[:, None]) & (dates < middle[:, None])
+    out_of_sample = (dates >= middle[:, None]) & (dates < end[:, None])
+    active = in_sample | out_of_sample
+
+    masks = dict()
+    for b, r in set(zip(begin.tolist(), rs.tolist())):
+        intervals = engine.rebalance_dates(datetime.combine(b, datetime.min.time()), r)
+        masks[b, r] = np.isin(dates, np.array(intervals, dtype="datetime64[D]"))
+    rebalance = np.array(
+        [masks[b, r] for b, r in zip(begin.tolist(), rs.tolist())]
+    ).reshape(len(combinations), len(dates))
+
+    values = engine.simulate_stack(
+        stack, strategy, losses, rebalance & active, active=active
+    )
+    result = {
+        "in_sample": metrics.summary(np.where(in_sample, values, np.nan)),
+        "out_of_sample": metrics.summary(np.where(out_of_sample, values, np.nan)),
+    }
+    return {
+        "{0}_{1}".format(sample, k): v
+        for sample, summary in result.items()
+        for k, v in summary.items()
+    }
+
+
+@instrument.stage("walk_forward")
+def walk_forward(args, start=None, train=365, test=90, step=90, workers=1, chunk=2048):
+    """
+    Walk-forward evaluation of every (strategy, loss, r) combination over
+    rolling windows: each run starts at a train start, like Krypfolio.main
+    from that date, and carries on through its test window; its metrics are
+    reported separately in sample (train) and out of sample (test)
+
+    The allocations are loaded once, and all the combinations of all the
+    windows are simulated together, chunk by chunk across a process pool.
+
+    Args:
+        args: [strategies, losses, rs]
+        start: first train start, the first date of the strategies by default
+        train, test, step: lengths of the windows and shift between them, in
+            days
+        workers: number of processes
+        chunk: number of combinations simulated at a time
+
+    Returns:
+        DataFrame with one row per combination and window
+    """
+
+    _strategy, _loss, _r = args
+    stack = engine.AllocationStack.from_matrices(load(_strategy))
+    periods = windows(stack.dates, start, train, test, step)
+    combinations = [
+        (k, b, m, e, loss, r)
+        for b, m, e in periods
+        for k in range(len(stack.names))
+        for loss in _loss
+        for r in _r
+    ]
+    chunks = [combinations[i : i + chunk] for i in range(0, len(combinations), chunk)]
+
+    if workers > 1 and len(chunks) > 1:
+        with Pool(workers, initializer=_init_stack, initargs=(stack,)) as p:
+            results = list(tqdm(p.imap(_walk, chunks), total=len(chunks)))
+    else:
+        _init_stack(stack)
+        results = [_walk(c) for c in tqdm(chunks)]
+
+    table = pd.DataFrame(
+        combinations,
+        columns=["strategy", "train_start", "test_start", "test_end", "loss", "r"],
+    )
+    table["strategy"] = [stack.names[k] for k in table["strategy"]]
+    for k in results[0] if results else list():
+        table[k] = np.concatenate([result[k] for result in results])
+    return table
+
+
+def select(table, metric="sharpe"):
+    """
+    Best in-sample combination of each window, with its out-of-sample score,
+    to compare how well in-sample rankings carry over
+
+    Returns:
+        DataFrame with one row per window
+    """
+
+    scored = table[np.isfinite(table["in_sample_" + metric])]
+    best = scored.loc[scored.groupby("train_start")["in_sample_" + metric].idxmax()]
+    return best.reset_index(drop=True)
+
+
+def main(start, budget=186, workers=None):
+    """
+    Search the HODL and the backtest parameters together, with the budget of
+    the former 31 x 6 grid by default, then generate and backtest the best
+    strategy
+
+    Returns:
+        the best parameters and the path of its daily values
+    """
+
+    with instrument.stage("hyperopt"):
+        objective = PoolObjective(start, workers=workers)
+        results = optimize(objective, TPESampler(), budget=budget)
+        objective.close()
+
+    # Only the best hyper-parameters are written to disk
+    best = results[0]
+    hodl = HODL(best["alpha"], best["n_coins"], best["cap"])
+    hodl.main(start)
+    krypfolio = Krypfolio(debug=False, engine="array")
+    krypfolio.main(strategy=hodl.name, start=start, loss=best["loss"], r=best["r"])
+    path = "./execution/results/{0}_{1}_{2}_{3}.csv".format(
+        hodl.name, start, best["loss"], best["r"]
+    )
+    return best, path
+
+
+if __name__ == "__main__":
+    from config import *
 
-    # Create full report for the best hyper-parameters with strategy
-    best = max(stats, key=lambda x: x[1])[0]
+    best, path = main(start)
     print(best)
-    # analysis(best, "report")
+    print(path)
+    # analysis(path, "report")
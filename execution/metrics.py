@@ -0,0 +1,137 @@
+import numpy as np
+
+# Periods per year, the quantstats default the grid search used so far
+PERIODS = 252
+
+
+def _rows(x):
+    return np.atleast_2d(np.asarray(x, dtype=float))
+
+
+def _squeeze(x, like):
+    return x[0] if np.ndim(like) == 1 else x
+
+
+def _previous(mask):
+    """
+    Index of the previous True position of each row, -1 if none
+    """
+
+    n = mask.shape[1]
+    index = np.where(mask, np.arange(n), -1)
+    index = np.maximum.accumulate(index, axis=1)
+    return np.concatenate([np.full((len(mask), 1), -1), index[:, :-1]], axis=1)
+
+
+def _next(mask):
+    """
+    Index of the next True position of each row, including itself, -1 if none
+    """
+
+    n = mask.shape[1]
+    index = np.where(mask, np.arange(n), n)
+    index = np.minimum.accumulate(index[:, ::-1], axis=1)[:, ::-1]
+    return np.where(index == n, -1, index)
+
+
+def to_returns(values):
+    """
+    Daily returns of portfolio values, (curves x dates) or a single curve
+
+    NaN values are gaps: the return is taken from the previous value, like
+    pct_change on the series without them. Infinite returns are dropped and
+    missing ones back-filled, as in hyperopt.analysis.
+    """
+
+    v = _rows(values)
+    observed = ~np.isnan(v)
+
+    previous = _previous(observed)
+    before = np.take_along_axis(v, np.clip(previous, 0, None), axis=1)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        returns = np.where(observed & (previous >= 0), v / before - 1, np.nan)
+    returns[np.isinf(returns)] = np.nan
+
+    # Back-fill among observed dates
+    found = observed & ~np.isnan(returns)
+    following = _next(found)
+    filled = np.take_along_axis(returns, np.clip(following, 0, None), axis=1)
+    returns = np.where(observed & np.isnan(returns) & (following >= 0), filled, returns)
+    return _squeeze(returns, values)
+
+
+def sharpe(returns, periods=PERIODS):
+    """
+    Annualized Sharpe ratio, zero risk-free rate
+    """
+
+    r = _rows(returns)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        res = np.nanmean(r, axis=1) / np.nanstd(r, axis=1, ddof=1)
+    return _squeeze(res * np.sqrt(periods), returns)
+
+
+def sortino(returns, periods=PERIODS):
+    """
+    Annualized Sortino ratio, zero risk-free rate
+    """
+
+    r = _rows(returns)
+    count = (~np.isnan(r)).sum(axis=1)
+    downside = np.sqrt(np.nansum(np.where(r < 0, r, 0) ** 2, axis=1) / count)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        res = np.where(downside == 0, np.nan, np.nanmean(r, axis=1) / downside)
+    return _squeeze(res * np.sqrt(periods), returns)
+
+
+def max_drawdown(values):
+    """
+    Largest peak to trough loss of portfolio values, as a negative fraction
+    """
+
+    v = _rows(values)
+    peak = np.fmax.accumulate(v, axis=1)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        res = np.nanmin(v / peak, axis=1) - 1
+    return _squeeze(res, values)
+
+
+def cagr(values, periods=PERIODS):
+    """
+    Compound annual growth rate of portfolio values, a year being periods
+    observations
+    """
+
+    v = _rows(values)
+    observed = ~np.isnan(v)
+    first = np.argmax(observed, axis=1)
+    last = v.shape[1] - 1 - np.argmax(observed[:, ::-1], axis=1)
+    rows = np.arange(len(v))
+    years = observed.sum(axis=1) / periods
+    with np.errstate(divide="ignore", invalid="ignore"):
+        res = (v[rows, last] / v[rows, first]) ** (1.0 / years) - 1
+    return _squeeze(res, values)
+
+
+def calmar(values, periods=PERIODS):
+    """
+    CAGR over the absolute max drawdown
+    """
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return cagr(values, periods) / np.abs(max_drawdown(values))
+
+
+def summary(values, periods=PERIODS):
+    """
+    All the metrics of portfolio values, as a dict of floats or arrays
+    """
+
+    returns = to_returns(values)
+    return {
+        "sharpe": sharpe(returns, periods),
+        "sortino": sortino(returns, periods),
+        "max_drawdown": max_drawdown(values),
+        "cagr": cagr(values, periods),
+        "calmar": calmar(values, periods),
+    }
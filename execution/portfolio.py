@@ -0,0 +1,255 @@
+import json
+import os
+from datetime import datetime
+
+import numpy as np
+
+import instrument
+from execution import engine
+from strategies import store
+
+
+def to_date(day):
+    """
+    Convert a date, datetime or "%Y-%m-%d" string to a date
+    """
+
+    if isinstance(day, str):
+        return datetime.strptime(day, "%Y-%m-%d").date()
+    if isinstance(day, datetime):
+        return day.date()
+    return day
+
+
+class PortfolioState:
+    """
+    Portfolio advanced one day at a time, with the rules of Krypfolio.main
+
+    The state is what the backtest carries from one day to the next: the
+    holdings in allocation order with their last prices, the high-water mark
+    of the trailing stop loss, the leftover investment and the portfolio
+    prices of the past rebalances the injection stages are based on. A step
+    costs O(n_coins), and the state can be saved and loaded as JSON, so a
+    daily rebalance does not replay the history.
+    """
+
+    def __init__(self, start, loss, r, investment=10000):
+        self.start = to_date(start).strftime("%Y-%m-%d")
+        self.loss = loss
+        self.r = r
+        self.investment = investment  # not invested yet
+        self.holdings = list()  # dicts of symbol, amount and close
+        self.max_balance = -np.inf
+        self.prices = list()  # portfolio price at each rebalance
+        self.injections = list()  # dicts of date, injection and fund
+        self.last = None  # last date stepped
+        self.value = investment
+        self.start_btc = None
+        self.start_date = None
+
+    def balance(self):
+        return sum([h["close"] * h["amount"] for h in self.holdings])
+
+    def is_rebalance(self, day):
+        """
+        Whether a day is a rebalance date: every r weeks from the start
+        """
+
+        days = (to_date(day) - to_date(self.start)).days
+        return days >= 0 and days % (7 * self.r) == 0
+
+    def _stop(self, balance_):
+        """
+        Sell everything if the balance fell more than loss below its high
+        """
+
+        if (
+            balance_ != 0
+            and self.max_balance > 0
+            and (self.max_balance - balance_) / self.max_balance > self.loss
+        ):
+            for h in self.holdings:
+                h["amount"] = 0
+            self.investment += balance_
+            self.max_balance = -np.inf
+            instrument.count("stop_losses")
+
+    def step(self, day, allocation, prices=None):
+        """
+        Advance the portfolio to a day
+
+        Args:
+            day: the day, after the last one stepped
+            allocation: list of dicts of symbol, close and ratio, the HODL
+                allocation of the day in its order
+            prices: optional dict of symbol -> close of a price feed, for
+                the held coins missing from the allocation; the backtest
+                only sees the allocation prices, so marking them to a feed
+                departs from it
+
+        Returns:
+            list of orders, dicts of symbol, amount to buy (negative to
+            sell) and close, empty if nothing changes
+        """
+
+        day = to_date(day)
+        if self.last is not None and day <= to_date(self.last):
+            raise ValueError("{} is not after {}".format(day, self.last))
+        self.last = day.strftime("%Y-%m-%d")
+
+        observed = dict(prices or dict())
+        observed.update({a["symbol"]: a["close"] for a in allocation})
+        before = {h["symbol"]: dict(h) for h in self.holdings}
+
+        if self.is_rebalance(day):
+            if np.abs(sum([a["ratio"] for a in allocation]) - 1) > 0.001:
+                return list()  # invalid allocation, skipped like the backtest
+
+            self._update(observed)
+            balance_ = self.balance()
+            price_ = sum([a["close"] * a["ratio"] for a in allocation])
+
+            fund, injection = engine.inject(
+                self.prices, price_, balance_, self.investment
+            )
+            balance_ += fund
+            self.investment -= fund
+            if injection is not None:
+                self.injections.append(
+                    {"date": self.last, "injection": injection, "fund": fund}
+                )
+
+            self.holdings = [
+                {
+                    "symbol": a["symbol"],
+                    "amount": a["ratio"] * balance_ / a["close"],
+                    "close": a["close"],
+                }
+                for a in allocation
+            ]
+            balance_ = self.balance()
+            self.value = balance_ + self.investment
+            self.prices.append(price_)
+            if balance_ > self.max_balance:
+                self.max_balance = balance_
+            self._stop(balance_)
+            instrument.count("rebalances")
+            if not self.start_btc:
+                self.start_btc = observed.get("bitcoin")
+                self.start_date = self.last
+        else:
+            self._update(observed)
+            balance_ = self.balance()
+            self.value = balance_ + self.investment
+            if balance_ > self.max_balance:
+                self.max_balance = balance_ + 0.001
+            self._stop(balance_)
+
+        return self.orders(before)
+
+    def _update(self, observed):
+        for h in self.holdings:
+            if h["symbol"] in observed:
+                h["close"] = observed[h["symbol"]]
+
+    def orders(self, before):
+        """
+        Changes of the holdings from the given ones, by symbol
+        """
+
+        after = {h["symbol"]: h for h in self.holdings}
+        orders = list()
+        for symbol in list(before) + [s for s in after if s not in before]:
+            old = before[symbol]["amount"] if symbol in before else 0
+            new = after[symbol]["amount"] if symbol in after else 0
+            if new != old:
+                close = (after.get(symbol) or before[symbol])["close"]
+                orders.append({"symbol": symbol, "amount": new - old, "close": close})
+        return orders
+
+    def replay(self, records):
+        """
+        Step through stored allocations, as store.records returns them, the
+        ones after the last day stepped and with bitcoin like the backtest
+        """
+
+        for record in records:
+            day = to_date(record["timestamp"])
+            if self.last is not None and day <= to_date(self.last):
+                continue
+            if "bitcoin" in [a["symbol"] for a in record["allocations"]]:
+                self.step(day, record["allocations"])
+        return self
+
+    def to_dict(self):
+        state = dict(self.__dict__)
+        state["max_balance"] = None if np.isinf(self.max_balance) else self.max_balance
+        return state
+
+    def save(self, path):
+        """
+        Write the state as JSON, atomically
+        """
+
+        folder = os.path.dirname(path)
+        if folder and not os.path.exists(folder):
+            os.makedirs(folder)
+        with open(path + ".tmp", "w") as f:
+            json.dump(self.to_dict(), f, indent=4)
+        os.replace(path + ".tmp", path)
+
+    @classmethod
+    def load(cls, path):
+        with open(path, "r") as f:
+            state = json.load(f)
+        portfolio = cls(state["start"], state["loss"], state["r"])
+        portfolio.__dict__.update(state)
+        if portfolio.max_balance is None:
+            portfolio.max_balance = -np.inf
+        return portfolio
+
+
+def parity(strategy, start, loss, r, investment=10000):
+    """
+    Largest difference between the daily values of a portfolio stepped
+    through the stored allocations of a strategy and the ones of
+    engine.simulate, 0 when it follows the backtest exactly
+    """
+
+    table = store.load(strategy)
+    matrix = engine.AllocationMatrix.from_table(table).having("bitcoin")
+    intervals = engine.rebalance_dates(datetime.strptime(start, "%Y-%m-%d"), r)
+    result = engine.simulate(matrix, loss, matrix.mask(intervals), investment)
+
+    portfolio = PortfolioState(start, loss, r, investment)
+    values = dict()
+    for record in store.records(table):
+        if "bitcoin" in [a["symbol"] for a in record["allocations"]]:
+            portfolio.step(record["timestamp"], record["allocations"])
+            values[np.datetime64(portfolio.last, "D")] = portfolio.value
+
+    days = result["timestamp"].astype("datetime64[D]")
+    return max(abs(values[day] - value) for day, value in zip(days, result["value"]))
+
+
+if __name__ == "__main__":
+    from config import *
+
+    # Daily rebalance job: step the saved state through the allocations
+    # stored since its last day, with the rules of the backtest
+    strategy = store.strategy_name(n_coins, alpha, cap)
+    path = "./execution/state/{0}_{1}_{2}_{3}.json".format(strategy, start, loss, r)
+    if os.path.exists(path):
+        portfolio = PortfolioState.load(path)
+    else:
+        portfolio = PortfolioState(start, loss, r)
+
+    orders = list()
+    for record in store.records(store.load(strategy, since=portfolio.last)):
+        if "bitcoin" in [a["symbol"] for a in record["allocations"]]:
+            orders = portfolio.step(record["timestamp"], record["allocations"])
+    portfolio.save(path)
+
+    print("{0}: {1}".format(portfolio.last, round(portfolio.value, 2)))
+    for order in orders:
+        print(order)
@@ -0,0 +1,152 @@
+import numpy as np
+import pandas as pd
+
+import instrument
+from execution import engine, metrics
+
+
+def gross_returns(matrix):
+    """
+    Daily gross returns of the coins of an allocation matrix, as simulate
+    sees their prices: a coin moves on the dates it is allocated, from its
+    last allocated price, and stays flat otherwise
+
+    Returns:
+        (dates x symbols) gross returns, 1 where a coin does not move
+    """
+
+    close = matrix.close
+    observed = ~np.isnan(close)
+    last = np.where(observed, np.arange(len(close))[:, None], -1)
+    last = np.maximum.accumulate(last, axis=0)
+    previous = np.vstack([np.full((1, close.shape[1]), -1), last[:-1]])
+    before = np.take_along_axis(close, np.clip(previous, 0, None), axis=0)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return np.where(observed & (previous >= 0), close / before, 1.0)
+
+
+def base_prices(matrix):
+    """
+    Price of each coin on the first date, its last allocated price so far or
+    its first one afterwards
+    """
+
+    close = matrix.close
+    observed = ~np.isnan(close)
+    first = np.where(observed.any(axis=0), observed.argmax(axis=0), 0)
+    price = close[first, np.arange(close.shape[1])]
+    return np.where(np.isnan(price), 0, price)
+
+
+def blocks(n_dates, paths, block, rng):
+    """
+    (paths x n_dates) indices of the dates of each path, made of blocks of
+    block consecutive dates starting at random
+    """
+
+    block = max(1, min(block, n_dates))
+    n_blocks = -(-n_dates // block)
+    starts = rng.integers(0, n_dates - block + 1, size=(paths, n_blocks))
+    index = starts[:, :, None] + np.arange(block)
+    return index.reshape(paths, n_blocks * block)[:, :n_dates]
+
+
+def resample(matrix, index):
+    """
+    AllocationStack of the paths given by their date indices: each path
+    takes the allocations of its dates, with prices compounding their coin
+    returns from the prices of the first date
+
+    The prices of every coin are compounded for a few paths at a time, as
+    many as keep them no larger than the allocated prices of all the paths,
+    so the memory used does not grow with the number of symbols.
+    """
+
+    stack = engine.AllocationStack.from_matrices({"": matrix})
+    order = stack.order[0][index]
+
+    # Gross returns and base prices with a padding column at 0
+    ones = np.ones((len(matrix.dates), 1))
+    gross = np.hstack([gross_returns(matrix), ones])
+    base = np.append(base_prices(matrix), 0)
+
+    close = np.empty(order.shape)
+    rows = max(1, len(index) * order.shape[2] // gross.shape[1])
+    for begin in range(0, len(index), rows):
+        paths = slice(begin, begin + rows)
+
+        # Prices of every coin along each path, in place; a path starts at
+        # the base prices, whatever its first date
+        level = gross[index[paths]]
+        level[:, 0] = 1
+        np.cumprod(level, axis=1, out=level)
+        level *= base
+        close[paths] = np.take_along_axis(level, order[paths], axis=2)
+
+    return engine.AllocationStack(
+        np.arange(len(index)),
+        np.arange(index.shape[1]).astype("datetime64[D]"),
+        matrix.symbols,
+        order,
+        stack.weights[0][index],
+        close,
+        stack.counts[0][index],
+    )
+
+
+@instrument.stage("bootstrap")
+def bootstrap(
+    matrix, loss, r, paths=10000, block=30, chunk=250, seed=None, investment=10000
+):
+    """
+    Robustness of a backtest under a moving block bootstrap: paths as long as
+    the history of the matrix are made of blocks of consecutive dates drawn
+    at random, with their allocations and coin returns, and all of them are
+    backtested with the rules of simulate, chunk by chunk
+
+    Args:
+        matrix: AllocationMatrix from the start date of the backtest
+        loss: trailing loss percentage
+        r: rebalance period in week, counted in dates of the path
+        paths: number of paths
+        block: number of consecutive dates of a block
+        chunk: number of paths simulated at a time
+        seed: seed of the random generator
+
+    Returns:
+        DataFrame with the final multiple and the metrics of each path
+    """
+
+    rng = np.random.default_rng(seed)
+    n_dates = len(matrix.dates)
+    rebalance = np.arange(n_dates) % (7 * r) == 0
+
+    results = list()
+    for begin in range(0, paths, chunk):
+        index = blocks(n_dates, min(chunk, paths - begin), block, rng)
+        stack = resample(matrix, index)
+        values = engine.simulate_stack(
+            stack,
+            np.arange(len(index)),
+            np.full(len(index), loss),
+            np.broadcast_to(rebalance, index.shape),
+            investment,
+        )
+        observed = ~np.isnan(values)
+        last = n_dates - 1 - observed[:, ::-1].argmax(axis=1)
+        result = pd.DataFrame(metrics.summary(values))
+        result.insert(0, "multiple", values[np.arange(len(values)), last] / investment)
+        results.append(result)
+    return pd.concat(results, ignore_index=True)
+
+
+if __name__ == "__main__":
+    from config import *
+
+    from strategies import store
+
+    strategy = store.strategy_name(n_coins, alpha, cap)
+    matrix = engine.AllocationMatrix.from_table(store.load(strategy)).having("bitcoin")
+    matrix = matrix.take(matrix.dates >= np.datetime64(start, "D"))
+    result = bootstrap(matrix, loss, r)
+    print(result.describe(percentiles=[0.05, 0.25, 0.5, 0.75, 0.95]))
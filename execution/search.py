@@ -0,0 +1,309 @@
+import itertools
+from collections import OrderedDict
+from datetime import datetime
+from multiprocessing import Pool, cpu_count
+
+import numpy as np
+
+import instrument
+from data import market
+from data.features import ewma_market_cap
+from data.panel import MarketPanel
+from execution import engine, metrics
+from strategies.cache import StrategyCache
+
+# Search space of the HODL and the backtest parameters
+SPACE = {
+    "alpha": list(range(1, 15)),
+    "n_coins": list(range(3, 21)),
+    "cap": [round(float(c), 2) for c in np.arange(0.10, 0.36, 0.02)],
+    "loss": [round(float(l), 2) for l in np.arange(0.05, 0.36, 0.01)],
+    "r": list(range(1, 7)),
+}
+
+
+class Objective:
+    """
+    Score of (alpha, n_coins, cap, loss, r) configurations over a prefix of
+    the history, the HODL allocations coming from a StrategyCache
+
+    The matrices of the last strategies are kept, so the rungs of a search
+    scoring the same strategy again only pay for the backtest.
+    """
+
+    def __init__(self, start, metric="sharpe", cache=None, maxsize=32):
+        self.start = datetime.strptime(start, "%Y-%m-%d")
+        self.metric = metric
+        self.cache = cache or StrategyCache()
+        self.maxsize = maxsize
+        self._matrices = OrderedDict()
+
+    def matrix(self, alpha, n_coins, cap):
+        """
+        Allocations of a HODL strategy from the start date, as an
+        AllocationMatrix
+        """
+
+        key = (alpha, n_coins, cap, self.start)
+        if key in self._matrices:
+            self._matrices.move_to_end(key)
+            return self._matrices[key]
+
+        table = self.cache.get(alpha, n_coins, cap, self.start)
+        matrix = engine.AllocationMatrix.from_table(table).having("bitcoin")
+
+        self._matrices[key] = matrix
+        if len(self._matrices) > self.maxsize:
+            self._matrices.popitem(last=False)
+        return matrix
+
+    def __call__(self, configs, fraction=1.0):
+        """
+        Scores of configurations over the first fraction of the history,
+        -inf when there is nothing to score
+
+        Configurations of the same strategy are backtested in one batch.
+        """
+
+        scores = np.full(len(configs), -np.inf)
+        groups = dict()
+        for i, c in enumerate(configs):
+            groups.setdefault((c["alpha"], c["n_coins"], c["cap"]), []).append(i)
+
+        for key, index in groups.items():
+            matrix = self.matrix(*key)
+            if len(matrix.dates) < 2:
+                continue
+            matrix = matrix.head(fraction)
+            masks = {
+                r: matrix.mask(engine.rebalance_dates(self.start, r))
+                for r in set(configs[i]["r"] for i in index)
+            }
+            values = engine.simulate_batch(
+                matrix,
+                [configs[i]["loss"] for i in index],
+                np.array([masks[configs[i]["r"]] for i in index]).reshape(
+                    len(index), len(matrix.dates)
+                ),
+            )
+            score = metrics.summary(values)[self.metric]
+            scores[index] = np.where(np.isfinite(score), score, -np.inf)
+        return scores
+
+
+# Objective of a pool worker, on the shared memory-mapped panel
+_objective = None
+
+
+def _init(path, start, metric):
+    global _objective
+    cache = StrategyCache(panel=MarketPanel.open(path))
+    _objective = Objective(start, metric, cache)
+
+
+def _score(args):
+    configs, fraction = args
+    return _objective(configs, fraction)
+
+
+class PoolObjective:
+    """
+    Objective scored across a process pool, one task per strategy
+
+    The market panel, with the EWMA of every alpha of the space, is written
+    once as memory-mapped arrays that all the workers open read-only, so
+    the memory used does not grow with the number of workers.
+    """
+
+    def __init__(
+        self, start, metric="sharpe", space=SPACE, workers=None, path="./data/panel"
+    ):
+        panel = market.load(["market_cap", "close"])
+        for alpha in space["alpha"]:
+            feature = "ewma_market_cap_{}_days".format(alpha)
+            panel.features[feature] = ewma_market_cap(panel, alpha)
+        panel.save(path)
+        self.pool = Pool(
+            workers or cpu_count(), initializer=_init, initargs=(path, start, metric)
+        )
+
+    def __call__(self, configs, fraction=1.0):
+        groups = dict()
+        for i, c in enumerate(configs):
+            groups.setdefault((c["alpha"], c["n_coins"], c["cap"]), []).append(i)
+
+        tasks = [([configs[i] for i in index], fraction) for index in groups.values()]
+        scores = np.full(len(configs), -np.inf)
+        for index, score in zip(groups.values(), self.pool.imap(_score, tasks)):
+            scores[index] = score
+        return scores
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+
+
+class RandomSampler:
+    """
+    Configurations drawn uniformly from the space
+    """
+
+    def __init__(self, space=SPACE, seed=None):
+        self.space = space
+        self.rng = np.random.default_rng(seed)
+
+    def ask(self, n):
+        return [
+            {k: v[self.rng.integers(len(v))] for k, v in self.space.items()}
+            for _ in range(n)
+        ]
+
+    def tell(self, configs, scores, fraction):
+        pass
+
+
+class TPESampler(RandomSampler):
+    """
+    Tree-structured Parzen estimator over the choices of each parameter
+
+    The observed configurations are split in the best gamma quantile and the
+    others, and the candidate maximizing the ratio of their smoothed choice
+    frequencies is proposed. Scores come from the largest fraction of the
+    history with enough observations, random until then.
+    """
+
+    def __init__(self, space=SPACE, seed=None, n_startup=20, gamma=0.25, candidates=24):
+        super().__init__(space, seed)
+        self.n_startup = n_startup
+        self.gamma = gamma
+        self.candidates = candidates
+        self.history = dict()  # fraction -> list of (config, score)
+
+    def tell(self, configs, scores, fraction):
+        self.history.setdefault(fraction, []).extend(zip(configs, scores))
+
+    def _observations(self):
+        for fraction in sorted(self.history, reverse=True):
+            if len(self.history[fraction]) >= self.n_startup:
+                return self.history[fraction]
+        return None
+
+    def _density(self, configs, key):
+        """
+        Frequency of each choice of a parameter, with one prior observation
+        spread over the choices
+        """
+
+        choices = self.space[key]
+        counts = np.ones(len(choices)) / len(choices)
+        for c in configs:
+            counts[choices.index(c[key])] += 1
+        return counts / counts.sum()
+
+    def ask(self, n):
+        observations = self._observations()
+        if observations is None:
+            return super().ask(n)
+
+        observations = sorted(observations, key=lambda x: -x[1])
+        split = max(1, int(np.ceil(self.gamma * len(observations))))
+        good = [c for c, _ in observations[:split]]
+        bad = [c for c, _ in observations[split:]]
+
+        densities = {
+            key: (self._density(good, key), self._density(bad, key))
+            for key in self.space
+        }
+
+        configs = list()
+        for _ in range(n):
+            candidates = [dict() for _ in range(self.candidates)]
+            ratio = np.zeros(self.candidates)
+            for key, choices in self.space.items():
+                l, g = densities[key]
+                drawn = self.rng.choice(len(choices), size=self.candidates, p=l)
+                for c, j in zip(candidates, drawn):
+                    c[key] = choices[j]
+                ratio += np.log(l[drawn]) - np.log(g[drawn])
+            configs.append(candidates[int(np.argmax(ratio))])
+        return configs
+
+
+class GridSampler:
+    """
+    Configurations of the exhaustive grid, in order
+    """
+
+    def __init__(self, space=SPACE):
+        self.space = space
+        self.configs = (
+            dict(zip(space.keys(), values))
+            for values in itertools.product(*space.values())
+        )
+
+    def ask(self, n):
+        return list(itertools.islice(self.configs, n))
+
+    def tell(self, configs, scores, fraction):
+        pass
+
+
+def fractions(eta, min_fraction):
+    """
+    Fractions of the history of successive halving, increasing by eta up
+    to the full history
+    """
+
+    rungs = [1.0]
+    while eta > 1 and rungs[0] / eta >= min_fraction - 1e-9:
+        rungs.insert(0, rungs[0] / eta)
+    return rungs
+
+
+@instrument.stage("optimize")
+def optimize(objective, sampler, budget=186, batch=27, eta=3, min_fraction=1 / 9):
+    """
+    Search the best configuration within a budget of full-history backtests
+
+    Each batch of sampled configurations goes through successive halving:
+    all of them are scored on the first fraction of the history, and only
+    the best 1 / eta carry on to a longer one, eta times longer, up to the
+    full history. Clearly bad configurations are then dropped early on short
+    windows. eta=1 scores every configuration on the full history.
+
+    Args:
+        objective: Objective
+        sampler: RandomSampler, TPESampler or GridSampler
+        budget: number of full-history backtests to spend, a backtest over a
+            fraction of the history costing that fraction
+        batch: configurations sampled at a time
+
+    Returns:
+        list of dicts with the parameters, score and fraction of the history
+        of every scored configuration, the best first
+    """
+
+    rungs = fractions(eta, min_fraction)
+    cost = 0.0
+    results = list()
+    while cost < budget:
+        configs = sampler.ask(batch)
+        if len(configs) == 0:
+            break
+        for i, fraction in enumerate(rungs):
+            with instrument.stage("rung {:.3g}".format(fraction)):
+                scores = objective(configs, fraction)
+            instrument.count("configurations", len(configs))
+            cost += fraction * len(configs)
+            sampler.tell(configs, scores, fraction)
+            results.extend(
+                dict(c, score=s, fraction=fraction) for c, s in zip(configs, scores)
+            )
+
+            if i + 1 < len(rungs):
+                keep = max(1, len(configs) // eta)
+                best = np.argsort(-scores, kind="stable")[:keep]
+                configs = [configs[j] for j in best if np.isfinite(scores[j])]
+            if len(configs) == 0 or cost >= budget:
+                break
+    return sorted(results, key=lambda x: (-x["fraction"], -x["score"]))
@@ -0,0 +1,174 @@
+"""
+Stage timers and counters of a run, off unless enabled by the
+KRYPFOLIO_INSTRUMENT environment variable or instrumentation in config.py
+
+    KRYPFOLIO_INSTRUMENT=1 python data/vendor.py
+    KRYPFOLIO_INSTRUMENT=./run.json KRYPFOLIO_PROFILE=HODL.main \
+        python strategies/hodl.py
+
+The value is 1 to print the summary as JSON on stderr at the end of the run,
+or the path of a JSON file to write it to. KRYPFOLIO_PROFILE (profile in
+config.py) lists stages, comma separated, to run under cProfile: their
+stats are written to ./execution/profiles/{stage}.prof and the top
+functions added to the summary.
+
+Stages nest, a stage run inside another being recorded as outer/inner.
+Counters go to the innermost running stage; the ones of pool workers are
+not collected.
+"""
+
+import atexit
+import cProfile
+import io
+import json
+import os
+import pstats
+import sys
+import time
+from contextlib import contextmanager
+
+try:
+    import config
+except ImportError:
+    config = None
+
+enabled = False
+output = None
+profiled = set()
+profile_folder = "./execution/profiles"
+
+_started = None
+_stack = list()
+_stages = dict()
+_counters = dict()
+
+
+def enable(path=None, profile=()):
+    """
+    Start collecting, the summary being written to path at exit, or printed
+    on stderr if path is None
+    """
+
+    global enabled, output, profiled, _started
+    if not enabled:
+        atexit.register(_write)
+        _started = time.perf_counter()
+    enabled = True
+    output = path
+    profiled = set(profile)
+
+
+def reset():
+    _stack.clear()
+    _stages.clear()
+    _counters.clear()
+
+
+def _record(path):
+    if path not in _stages:
+        _stages[path] = {"calls": 0, "seconds": 0.0, "counters": dict()}
+    return _stages[path]
+
+
+@contextmanager
+def stage(name):
+    """
+    Time a stage, as a context manager or a decorator
+    """
+
+    if not enabled:
+        yield
+        return
+
+    _stack.append(name)
+    record = _record("/".join(_stack))  # outer stages listed first
+    profiler = None
+    if name in profiled:
+        profiler = cProfile.Profile()
+        profiler.enable()
+    begin = time.perf_counter()
+    try:
+        yield
+    finally:
+        seconds = time.perf_counter() - begin
+        _stack.pop()
+        record["calls"] += 1
+        record["seconds"] += seconds
+        if profiler is not None:
+            profiler.disable()
+            record["profile"] = _dump(profiler, name)
+
+
+def count(name, n=1):
+    """
+    Add n to a counter of the running stage
+    """
+
+    if not enabled:
+        return
+    n = int(n)
+    _counters[name] = _counters.get(name, 0) + n
+    if len(_stack) > 0:
+        counters = _record("/".join(_stack))["counters"]
+        counters[name] = counters.get(name, 0) + n
+
+
+def _dump(profiler, name, top=15):
+    """
+    Write the stats of a profiled stage, and return its top functions by
+    cumulative time
+    """
+
+    if not os.path.exists(profile_folder):
+        os.makedirs(profile_folder)
+    profiler.dump_stats(os.path.join(profile_folder, name + ".prof"))
+
+    stream = io.StringIO()
+    stats = pstats.Stats(profiler, stream=stream)
+    stats.sort_stats("cumulative").print_stats(top)
+    lines = stream.getvalue().splitlines()
+    header = [i for i, line in enumerate(lines) if line.lstrip().startswith("ncalls")]
+    return [line for line in lines[header[0] + 1 :] if line] if header else list()
+
+
+def summary():
+    """
+    Timings and counters of the stages run so far
+    """
+
+    return {
+        "script": os.path.basename(sys.argv[0]) if sys.argv else None,
+        "date": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "seconds": time.perf_counter() - _started if _started is not None else None,
+        "stages": _stages,
+        "counters": _counters,
+    }
+
+
+def _write():
+    if len(_stages) == 0 and len(_counters) == 0:
+        return
+    report = json.dumps(summary(), indent=4)
+    if output is None:
+        print(report, file=sys.stderr)
+    else:
+        with open(output, "w") as f:
+            f.write(report)
+
+
+def _settings():
+    value = os.environ.get(
+        "KRYPFOLIO_INSTRUMENT", getattr(config, "instrumentation", None)
+    )
+    profile = os.environ.get("KRYPFOLIO_PROFILE", getattr(config, "profile", ()))
+    if isinstance(profile, str):
+        profile = [name.strip() for name in profile.split(",") if name.strip()]
+    if value in (None, False, "", "0", "false", "False"):
+        if len(profile) == 0:
+            return
+        value = True
+    path = None if value in (True, 1, "1", "true", "True") else value
+    enable(path, profile)
+
+
+_settings()
@@ -0,0 +1,167 @@
+"""
+Command line of the Krypfolio pipeline, one subcommand per stage
+
+    python krypfolio.py fetch
+    python krypfolio.py clean --method mad
+    python krypfolio.py allocate --alpha 3 --n-coins 10 --cap 0.18
+    python krypfolio.py backtest --config ./configs/hodl20.py --loss 0.1
+    python krypfolio.py optimize --budget 60
+    python krypfolio.py report
+
+The parameters are read from config.py when there is one, then from the
+file given by --config, written like config.py, then from the flags. A
+subcommand only imports the modules of its stage, so a cron job does not
+pay for pandas, scikit-learn or quantstats when it does not need them.
+"""
+
+import argparse
+import os
+import runpy
+import sys
+
+# Parameters of the strategy and the backtest, as in config.py.sample
+DEFAULTS = {
+    "alpha": 3,
+    "n_coins": 10,
+    "cap": 0.18,
+    "loss": 0.12,
+    "r": 2,
+    "start": "2019-01-01",
+    "regime": False,
+}
+
+
+def settings(args):
+    """
+    Parameters of a run: config.py, then the --config file, then the flags
+    """
+
+    if args.config is not None and not os.path.exists(args.config):
+        sys.exit("No config file {}".format(args.config))
+
+    result = dict(DEFAULTS)
+    for path in ["config.py", args.config]:
+        if path is not None and os.path.exists(path):
+            values = runpy.run_path(path)
+            result.update({k: values[k] for k in DEFAULTS if k in values})
+    flags = {k: getattr(args, k, None) for k in DEFAULTS}
+    result.update({k: v for k, v in flags.items() if v is not None})
+    return result
+
+
+def strategy(params):
+    from strategies import store
+
+    return store.strategy_name(
+        params["n_coins"], params["alpha"], params["cap"], params["regime"]
+    )
+
+
+def fetch(params, args):
+    from data import vendor
+
+    vendor.market_info()
+
+
+def clean(params, args):
+    from data import vendor
+
+    coins = vendor.reprocess(args.coins, method=args.method, workers=args.workers)
+    if len(coins) == 0:
+        sys.exit("No raw data to clean in ./data/raw, run fetch first")
+
+
+def allocate(params, args):
+    from strategies.hodl import HODL
+
+    hodl = HODL(params["alpha"], params["n_coins"], params["cap"], params["regime"])
+    hodl.main(params["start"])
+    print(hodl.name)
+
+
+def backtest(params, args):
+    from execution.backtest import Krypfolio
+
+    krypfolio = Krypfolio(debug=args.verbose, engine=args.engine)
+    values = krypfolio.main(
+        strategy=args.strategy or strategy(params),
+        loss=params["loss"],
+        r=params["r"],
+        start=params["start"],
+    )
+    print(values.tail())
+
+
+def optimize(params, args):
+    from execution import hyperopt
+
+    best, path = hyperopt.main(params["start"], args.budget, args.workers)
+    print(best)
+    print(path)
+
+
+def report(params, args):
+    from execution import hyperopt
+
+    path = args.path or "./execution/results/{0}_{1}_{2}_{3}.csv".format(
+        args.strategy or strategy(params), params["start"], params["loss"], params["r"]
+    )
+    if not os.path.exists(path):
+        sys.exit("No backtest results {}, run backtest first".format(path))
+    hyperopt.analysis(path, "report")
+    print(path.replace("csv", "html").replace("/results", ""))
+
+
+def parser():
+    common = argparse.ArgumentParser(add_help=False)
+    common.add_argument("--config", default=None, help="config file like config.py")
+    common.add_argument("--alpha", type=int, help="half-life of the EWMA, in days")
+    common.add_argument("--n-coins", dest="n_coins", type=int)
+    common.add_argument("--cap", type=float, help="cap of the weight of a coin")
+    common.add_argument("--loss", type=float, help="trailing stop loss")
+    common.add_argument("-r", type=int, help="rebalance period, in weeks")
+    common.add_argument("--start", help="start date, YYYY-MM-DD")
+    regime = common.add_mutually_exclusive_group()
+    regime.add_argument(
+        "--regime", action="store_true", default=None, help="HODL regime filter"
+    )
+    regime.add_argument(
+        "--no-regime", dest="regime", action="store_false", default=None
+    )
+
+    result = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    commands = result.add_subparsers(dest="command", required=True)
+
+    p = commands.add_parser("fetch", parents=[common], help="download market data")
+    p.set_defaults(run=fetch)
+
+    p = commands.add_parser("clean", parents=[common], help="remove outliers")
+    p.add_argument("--method", choices=["lof", "mad"], default="lof")
+    p.add_argument("--coins", nargs="+", default=None)
+    p.add_argument("--workers", type=int, default=None)
+    p.set_defaults(run=clean)
+
+    p = commands.add_parser("allocate", parents=[common], help="HODL allocations")
+    p.set_defaults(run=allocate)
+
+    p = commands.add_parser("backtest", parents=[common], help="backtest a strategy")
+    p.add_argument("--strategy", default=None, help="stored strategy name")
+    p.add_argument("--engine", choices=["loop", "array"], default="loop")
+    p.add_argument("--verbose", action="store_true")
+    p.set_defaults(run=backtest)
+
+    p = commands.add_parser("optimize", parents=[common], help="parameter search")
+    p.add_argument("--budget", type=int, default=186)
+    p.add_argument("--workers", type=int, default=None)
+    p.set_defaults(run=optimize)
+
+    p = commands.add_parser("report", parents=[common], help="quantstats report")
+    p.add_argument("--strategy", default=None, help="stored strategy name")
+    p.add_argument("--path", default=None, help="CSV of daily backtest values")
+    p.set_defaults(run=report)
+    return result
+
+
+if __name__ == "__main__":
+    args = parser().parse_args()
+    args.run(settings(args), args)
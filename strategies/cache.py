@@ -0,0 +1,137 @@
+import os
+from collections import OrderedDict
+
+import numpy as np
+
+from data import market
+from data.features import ewma_market_cap
+from data.panel import to_day
+from strategies import store
+from strategies.hodl import HODL
+
+
+def _nbytes(table):
+    return sum(v.nbytes for v in table.values())
+
+
+def _concat(tables):
+    columns = [c for c in tables[0] if all(c in t for t in tables)]
+    return {c: np.concatenate([t[c] for t in tables]) for c in columns}
+
+
+def _between(table, begin, end):
+    keep = (table["date"] >= begin) & (table["date"] <= end)
+    return {c: v[keep] for c, v in table.items()}
+
+
+class StrategyCache:
+    """
+    Allocations of HODL strategies by (alpha, n_coins, cap) and date range,
+    as columnar tables (see strategies.store)
+
+    A strategy is served from memory, else from its stored allocations, and
+    only the dates outside of those are computed. The EWMA of an alpha is
+    computed once for all the n_coins and cap variants. The least recently
+    used strategies are evicted past max_bytes.
+    """
+
+    def __init__(self, panel=None, folder="./strategies", max_bytes=256 * 2**20):
+        self.panel = panel
+        self.folder = folder
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()  # key -> (first date, last date, table)
+
+    def load_panel(self):
+        if self.panel is None:
+            self.panel = market.load(["market_cap", "close"])
+        return self.panel
+
+    def ewma(self, alpha):
+        """
+        EWMA market cap of an alpha, shared by every strategy using it
+        """
+
+        panel = self.load_panel()
+        feature = "ewma_market_cap_{}_days".format(alpha)
+        if not panel.has([feature]):
+            panel.features[feature] = ewma_market_cap(panel, alpha)
+        return panel.features[feature]
+
+    def compute(self, alpha, n_coins, cap, begin, end):
+        """
+        Allocations of the panel dates between begin and end, led by bitcoin
+        like the ones HODL.main stores
+        """
+
+        panel = self.load_panel()
+        self.ewma(alpha)
+
+        hodl = HODL(alpha, n_coins, cap)
+        hodl.panel = panel
+        dates = panel.dates[(panel.dates >= begin) & (panel.dates <= end)]
+        _, order, counts, market_cap, close, ratios = hodl.rank(dates)
+
+        # Rows of the kept dates, in date then rank order
+        ranked = np.arange(order.shape[1]) < counts[:, None]
+        if "bitcoin" in panel.symbols:
+            btc = panel.symbols.index("bitcoin")
+            ranked &= ((counts > 0) & (order[:, 0] == btc))[:, None]
+        else:
+            ranked[:] = False
+        return {
+            "date": np.repeat(dates, ranked.sum(axis=1)),
+            "symbol": np.array(panel.symbols, dtype=str)[order[ranked]],
+            "ratio": ratios[ranked],
+            "close": close[ranked],
+            "ewma_market_cap": market_cap[ranked],
+        }
+
+    def _stored(self, strategy):
+        path = os.path.join(self.folder, strategy)
+        if not (
+            os.path.exists(path)
+            or os.path.exists(path + ".jsonl")
+            or os.path.exists(path + ".json")
+        ):
+            return None
+        table = store.load(strategy, self.folder)
+        if len(table["date"]) == 0:
+            return None
+        return table["date"].min(), table["date"].max(), table
+
+    def get(self, alpha, n_coins, cap, start, end=None):
+        """
+        Allocations of a strategy between the start and end dates, both
+        included, end being the last date of the panel by default
+        """
+
+        key = (alpha, n_coins, cap)
+        begin = to_day(start)
+        end = to_day(end) if end is not None else self.load_panel().dates[-1]
+
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            entry = self._stored(store.strategy_name(n_coins, alpha, cap))
+        if entry is None:
+            entry = (begin, end, self.compute(alpha, n_coins, cap, begin, end))
+
+        # Only compute the dates the entry does not cover yet
+        first, last, table = entry
+        tables = [table]
+        if begin < first:
+            before = self.compute(alpha, n_coins, cap, begin, first - 1)
+            tables.insert(0, before)
+        if end > last:
+            tables.append(self.compute(alpha, n_coins, cap, last + 1, end))
+        if len(tables) > 1:
+            entry = (min(first, begin), max(last, end), _concat(tables))
+
+        self._entries[key] = entry
+        self._evict()
+        return _between(entry[2], begin, end)
+
+    def _evict(self):
+        size = sum(_nbytes(table) for _, _, table in self._entries.values())
+        while len(self._entries) > 1 and size > self.max_bytes:
+            _, (_, _, table) = self._entries.popitem(last=False)
+            size -= _nbytes(table)
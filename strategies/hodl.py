@@ -1,19 +1,12 @@
-import glob
-import json
-import multiprocessing
-import ntpath
-import traceback
-from datetime import date, datetime
-from multiprocessing import Pool
+from datetime import date, datetime, timedelta
 
 import numpy as np
-import pandas as pd
 from dateutil import rrule
-from requests import Session
-from requests.exceptions import ConnectionError, Timeout, TooManyRedirects
-from tqdm.auto import tqdm
 
-from config import *
+import instrument
+from data import changepoints, market
+from data.features import ewma_market_cap
+from strategies import store
 
 # Default headers for Coinmarketcap
 headers = {
@@ -24,10 +17,14 @@ headers = {
 
 
 class HODL:
-    def __init__(self, alpha, n_coins, cap):
+    def __init__(self, alpha, n_coins, cap, regime=False):
         self.alpha = alpha
         self.n_coins = n_coins
         self.cap = cap
+        self.regime = regime  # leave out the coins in a downward regime
+        self.name = store.strategy_name(n_coins, alpha, cap, regime)
+        self.panel = None
+        self.filters = ["regime"] if regime else list()
 
     def list_binance(self):
         """
@@ -35,6 +32,9 @@ class HODL:
         and match with CoinMarketCap
         """
 
+        from requests import Session
+        from requests.exceptions import ConnectionError, Timeout, TooManyRedirects
+
         session = Session()
         session.headers.update(headers)
 
@@ -72,49 +72,59 @@ class HODL:
 
     def weighted_market_cap(self):
         """
-        Calculate exponential weighted moving average market cap
+        Calculate exponential weighted moving average market cap, kept in the
+        feature store rather than in the processed CSVs
+        """
+
+        if self.panel is None or not self.panel.has(["market_cap"]):
+            self.panel = market.load(["market_cap", "close"])
+        feature = "ewma_market_cap_{}_days".format(self.alpha)
+        self.panel.features[feature] = ewma_market_cap(self.panel, self.alpha)
+        return self.panel.features[feature]
+
+    def load_panel(self, features):
+        """
+        Load the processed data into an in-memory panel, once per run, with
+        the EWMA market cap from the feature store
         """
 
-        all_data = sorted(glob.glob("./data/processed/*.csv"))
-        for path in tqdm(all_data):
-            df = pd.read_csv(path)
+        feature = "ewma_market_cap_{}_days".format(self.alpha)
+        columns = [ft for ft in features if ft not in (feature, "regime")]
+        if feature in features:
+            columns = list(dict.fromkeys(columns + ["market_cap"]))
+        if "regime" in features:
+            columns = list(dict.fromkeys(columns + ["close"]))
+        self.panel = market.load(columns)
+        if feature in features:
+            self.weighted_market_cap()
+        if "regime" in features:
+            self.regime_filter()
+        return self.panel
+
+    def regime_filter(self):
+        """
+        1 where a coin can be allocated, NaN where the latest change point
+        of its close price is a drop, from the cached change points; bitcoin
+        always stays, the allocations being led by it
+        """
 
-            # Exponentially weighted moving average
-            if "ewma_market_cap_{}_days".format(self.alpha) not in df.columns:
-                times = pd.to_datetime(df["timestamp"].values)
-                market_cap = df.copy()
-                market_cap = market_cap[["market_cap"]]
-                market_cap.columns = ["ewma_market_cap_{}_days".format(self.alpha)]
-                market_cap = market_cap.ewm(
-                    halflife="{} days".format(self.alpha), times=pd.DatetimeIndex(times)
-                ).mean()
-                df = pd.concat([df, market_cap], axis=1)
-                df.to_csv(path, index=False)
+        direction = changepoints.regimes(
+            self.panel, changepoints.detect(self.panel, "close")
+        )
+        allowed = np.where(direction < 0, np.nan, 1.0)
+        if "bitcoin" in self.panel.symbols:
+            allowed[:, self.panel.symbols.index("bitcoin")] = 1.0
+        self.panel.features["regime"] = allowed
+        return allowed
 
     def data_at_date(self, dt, features):
         """
         Prepare data at a given date
         """
 
-        all_data = sorted(glob.glob("./data/processed/*.csv"))
-        data = list()
-        for path in all_data:
-            try:
-                df = pd.read_csv(path)
-
-                df["timestamp"] = pd.to_datetime(df["timestamp"].values)
-                df["timestamp"] = df["timestamp"].dt.date
-                df = df[df["timestamp"] == pd.Timestamp(dt)]
-                if len(df) > 0:
-                    if all(df[ft].values[0] for ft in features) > 0:
-                        tmp = {"name": ntpath.basename(path).replace(".csv", "")}
-                        for ft in features:
-                            tmp[ft] = df[ft].values[0]
-                        data.append(tmp)
-            except Exception as e:
-                traceback.print_tb(e.__traceback__)
-                continue
-        return data
+        if self.panel is None or not self.panel.has(features):
+            self.load_panel(features)
+        return self.panel.at(dt, features)
 
     def allocate(self, dt):
         """
@@ -125,7 +135,7 @@ class HODL:
         # coins = self.list_binance()
 
         market = self.data_at_date(
-            dt, ["ewma_market_cap_{}_days".format(self.alpha), "close"]
+            dt, ["ewma_market_cap_{}_days".format(self.alpha), "close"] + self.filters
         )
         # market = [m for m in market if m["name"] in coins.keys()]  # filter
         market = list(
@@ -184,41 +194,134 @@ class HODL:
                     new_allocs.append(n_alloc)
 
                 allocations = allocations[: i + 1] + new_allocs
+        instrument.count("allocations")
         return {"timestamp": dt, "allocations": allocations}
 
-    def main(self, start):
+    def rank(self, intervals):
+        """
+        Calculate krypfolio for all dates at once, as (dates x coins) array
+        operations equivalent to calling allocate on each date
+
+        Returns:
+            found: whether each date is in the panel
+            order: (found dates x n_coins) panel columns by descending EWMA
+            counts: number of allocated coins of each found date
+            market_cap, close, ratios: (found dates x n_coins) of each rank
+        """
 
-        # Load pre-calculated portfolio
-        try:
-            pre = json.load(
-                open(
-                    "./strategies/HODL{0}-{1}-days-{2}-cap.json".format(
-                        self.n_coins, self.alpha, str(int(100 * self.cap))
-                    ),
-                    "r",
+        feature = "ewma_market_cap_{}_days".format(self.alpha)
+        features = [feature, "close"] + self.filters
+        if self.panel is None or not self.panel.has(features):
+            self.load_panel(features)
+
+        rows = [self.panel.row(dt) for dt in intervals]
+        found = np.array([i is not None for i in rows], dtype=bool)
+        index = np.array([i for i in rows if i is not None], dtype=int)
+
+        ewma = self.panel.features[feature][index]
+        close = self.panel.features["close"][index]
+        valid = self.panel.valid(features)[index]
+
+        # Top n_coins by descending EWMA market cap, ties keep column order
+        order = np.argsort(np.where(valid, -ewma, np.inf), axis=1, kind="stable")[
+            :, : self.n_coins
+        ]
+        selected = np.take_along_axis(valid, order, axis=1)
+        market_cap = np.where(selected, np.take_along_axis(ewma, order, axis=1), 0)
+        close = np.take_along_axis(close, order, axis=1)
+        counts = selected.sum(axis=1)
+
+        # cumsum adds left to right, the same rounding as the builtin sum
+        sqrt_cap = np.sqrt(market_cap)
+        total_cap = np.cumsum(sqrt_cap, axis=1)[:, -1:]
+        with np.errstate(invalid="ignore", divide="ignore"):
+            ratios = sqrt_cap / total_cap  # ratios (sums to 100%)
+
+            # Spread the overflow of capped coins to the remaining ones,
+            # rank by rank so an overflow can push a later coin over the cap
+            for i in range(order.shape[1]):
+                capped = selected[:, i] & (ratios[:, i] > self.cap)
+                overflow = ratios[:, i] - self.cap
+                ratios[capped, i] = self.cap
+
+                remaining = market_cap[capped, i + 1 :]
+                total_nested_cap = np.cumsum(remaining, axis=1)[:, -1:]
+                ratios[capped, i + 1 :] += overflow[capped, None] * (
+                    remaining / total_nested_cap
                 )
+        instrument.count("allocations", len(index))
+        return found, order, counts, market_cap, close, ratios
+
+    def allocate_all(self, intervals):
+        """
+        Calculate krypfolio for all dates at once, as the list of allocations
+        allocate returns
+        """
+
+        found, order, counts, market_cap, close, ratios = self.rank(intervals)
+
+        allocations = list()
+        k = 0
+        for dt, has_row in zip(intervals, found):
+            if not has_row:
+                allocations.append({"timestamp": dt, "allocations": list()})
+                continue
+            allocations.append(
+                {
+                    "timestamp": dt,
+                    "allocations": [
+                        {
+                            "symbol": self.panel.symbols[order[k, j]],
+                            "ewma_market_cap": market_cap[k, j],
+                            "close": close[k, j],
+                            "ratio": ratios[k, j],
+                        }
+                        for j in range(counts[k])
+                    ],
+                }
             )
-            timestamps = pre.keys()
-        except:
-            pre = dict()
-            timestamps = list()
+            k += 1
+        return allocations
+
+    @instrument.stage("HODL.main")
+    def main(self, start):
+        """
+        Compute the allocations after the last stored date and append them
+        to the stored strategy, and the ones from start to the first stored
+        date when start is earlier, inserted before them
+        """
+
+        feature = "ewma_market_cap_{}_days".format(self.alpha)
+
+        # Resume from the stored portfolio
+        store.migrate(self.name)
+        first = store.first_date(self.name)
+        last = store.last_date(self.name)
 
-        # Prepare EWMA
-        self.weighted_market_cap()
+        # Prepare EWMA, only for the observations the feature store has not
+        # seen yet
+        with instrument.stage("load_panel"):
+            self.load_panel([feature, "close"] + self.filters)
 
-        # Iterate daily except in timestamps
+        # Iterate daily before the first and after the last stored date
         start = datetime.strptime(start, "%Y-%m-%d")
+        earlier = list()
+        if last is not None:
+            earlier = list(
+                rrule.rrule(
+                    rrule.DAILY,
+                    dtstart=start,
+                    until=datetime.strptime(first, "%Y-%m-%d") - timedelta(days=1),
+                )
+            )
+            start = max(start, datetime.strptime(last, "%Y-%m-%d") + timedelta(days=1))
         today = date.today()
 
-        intervals = list(rrule.rrule(rrule.DAILY, dtstart=start, until=today))
-        intervals = [i for i in intervals if i.strftime("%Y-%m-%d") not in timestamps]
+        intervals = earlier + list(rrule.rrule(rrule.DAILY, dtstart=start, until=today))
 
-        allocations = list()
-        # Use multiprocessing
-        with Pool(multiprocessing.cpu_count() - 2) as p:
-            allocations = list(
-                tqdm(p.imap(self.allocate, intervals), total=len(intervals))
-            )
+        # All dates in one pass over the panel
+        with instrument.stage("allocate_all"):
+            allocations = self.allocate_all(intervals)
 
         # Transform to dictionary
         allocations = sorted(
@@ -230,23 +333,25 @@ class HODL:
             for alloc in allocations
             if alloc["allocations"][0]["symbol"] == "bitcoin"
         ]
-        for alloc in allocations:
-            pre[alloc["timestamp"].strftime("%Y-%m-%d")] = alloc["allocations"]
-        return pre
+        allocations = {
+            alloc["timestamp"].strftime("%Y-%m-%d"): alloc["allocations"]
+            for alloc in allocations
+        }
+
+        with instrument.stage("store"):
+            if len(earlier) > 0:
+                store.prepend(
+                    self.name, {k: v for k, v in allocations.items() if k < first}
+                )
+            store.append(
+                self.name,
+                {k: v for k, v in allocations.items() if first is None or k > first},
+            )
+        return allocations
 
 
 if __name__ == "__main__":
+    from config import *
+
     hodl = HODL(alpha, n_coins, cap)
-    allocations = hodl.main(start)
-    json.dump(
-        allocations,
-        open(
-            "./strategies/HODL{0}-{1}-days-{2}-cap.json".format(
-                n_coins, alpha, str(int(100 * cap))
-            ),
-            "w",
-        ),
-        indent=4,
-        sort_keys=True,
-        default=str,
-    )
+    hodl.main(start)
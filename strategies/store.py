@@ -0,0 +1,310 @@
+import glob
+import json
+import os
+from datetime import datetime
+
+import numpy as np
+
+import instrument
+
+# Columns of an allocation table, besides date and symbol
+COLUMNS = ["ratio", "close", "ewma_market_cap", "amount"]
+
+# Parts of a directory past which they are merged into one part per year
+max_parts = 32
+
+
+def strategy_name(n_coins, alpha, cap, regime=False):
+    name = "HODL{0}-{1}-days-{2}-cap".format(n_coins, alpha, str(int(100 * cap)))
+    return name + "-regime" if regime else name
+
+
+def to_table(allocations):
+    """
+    Flatten a dict of date -> allocations into columns, one row per coin
+    """
+
+    dates = sorted(allocations.keys())
+    rows = [(k, alloc) for k in dates for alloc in allocations[k]]
+    table = {
+        "date": np.array([k for k, _ in rows], dtype="datetime64[D]"),
+        "symbol": np.array([alloc["symbol"] for _, alloc in rows], dtype=str),
+    }
+    for col in COLUMNS:
+        if all(col in alloc for _, alloc in rows) and len(rows) > 0:
+            table[col] = np.array([alloc[col] for _, alloc in rows], dtype=float)
+    return table
+
+
+def _groups(table):
+    """
+    Distinct dates of a table with the row range of each, rows of a date
+    being contiguous
+    """
+
+    dates, first = np.unique(table["date"], return_index=True)
+    bounds = list(first[1:]) + [len(table["date"])]
+    return zip(dates.tolist(), first.tolist(), bounds)
+
+
+def _columns(table):
+    columns = [col for col in COLUMNS if col in table]
+    return table["symbol"].tolist(), {col: table[col].tolist() for col in columns}
+
+
+def _rows(columns, i, j):
+    symbols, values = columns
+    return [
+        dict(symbol=symbols[n], **{col: v[n] for col, v in values.items()})
+        for n in range(i, j)
+    ]
+
+
+def from_table(table):
+    """
+    Rebuild the dict of date -> allocations from columns
+    """
+
+    columns = _columns(table)
+    return {d.strftime("%Y-%m-%d"): _rows(columns, i, j) for d, i, j in _groups(table)}
+
+
+def records(table):
+    """
+    Rebuild the list of {timestamp, allocations} the backtest walks through
+    """
+
+    columns = _columns(table)
+    return [
+        {
+            "timestamp": datetime(d.year, d.month, d.day),
+            "allocations": _rows(columns, i, j),
+        }
+        for d, i, j in _groups(table)
+    ]
+
+
+def _parts(path):
+    return sorted(glob.glob(os.path.join(path, "part-*.npz")))
+
+
+def _read_part(part):
+    with np.load(part) as f:
+        return {col: f[col] for col in f.files}
+
+
+def _after(table, since):
+    """
+    Rows of a table after a date
+    """
+
+    keep = table["date"] > np.datetime64(since, "D")
+    return {col: values[keep] for col, values in table.items()}
+
+
+def read_table(path, since=None):
+    """
+    Load every part of a columnar allocation directory, or only the rows
+    after a date, reading the last parts only
+    """
+
+    parts = list()
+    for part in reversed(_parts(path)):
+        parts.insert(0, _read_part(part))
+        if since is not None and parts[0]["date"].min() <= np.datetime64(since, "D"):
+            break
+    instrument.count("files_read", len(parts))
+    if len(parts) == 0:
+        return {
+            "date": np.array([], dtype="datetime64[D]"),
+            "symbol": np.array([], dtype=str),
+        }
+    columns = [col for col in parts[0] if all(col in p for p in parts)]
+    table = {col: np.concatenate([p[col] for p in parts]) for col in columns}
+    return _after(table, since) if since is not None else table
+
+
+def _write_part(part, table):
+    with open(part + ".tmp", "wb") as f:
+        np.savez_compressed(f, **table)
+    os.replace(part + ".tmp", part)
+
+
+def compact(path):
+    """
+    Merge the parts of a columnar allocation directory into one part per
+    year, numbered from the first one
+    """
+
+    parts = _parts(path)
+    table = read_table(path)
+    years = table["date"].astype("datetime64[Y]")
+    merged = np.unique(years)
+    for n, year in enumerate(merged):
+        keep = years == year
+        part = os.path.join(path, "part-{:05d}.npz".format(n))
+        _write_part(part, {col: values[keep] for col, values in table.items()})
+    for part in parts[len(merged) :]:
+        os.remove(part)
+
+
+def append_table(path, table):
+    """
+    Write a table as a new part, leaving the existing parts untouched until
+    there are more than max_parts of them, then merge them by year
+    """
+
+    if len(table["date"]) == 0:
+        return
+    if not os.path.exists(path):
+        os.makedirs(path)
+    parts = _parts(path)
+    n = int(os.path.basename(parts[-1])[5:10]) + 1 if parts else 0
+    _write_part(os.path.join(path, "part-{:05d}.npz".format(n)), table)
+    if len(parts) + 1 > max_parts:
+        compact(path)
+
+
+def write(path, allocations, fmt="npz"):
+    """
+    Write allocations (dict of date -> allocations) to a columnar directory,
+    or to a pretty-printed JSON file with fmt="json"
+    """
+
+    if fmt == "json":
+        json.dump(
+            allocations,
+            open(path + ".json", "w"),
+            indent=4,
+            sort_keys=True,
+            default=str,
+        )
+        return
+    for part in _parts(path):
+        os.remove(part)
+    append_table(path, to_table(allocations))
+
+
+def _strategy_path(strategy, folder):
+    return os.path.join(folder, strategy)
+
+
+def read(strategy, folder="./strategies"):
+    """
+    Load the stored allocations of a strategy as a dict of date -> allocations
+    """
+
+    return from_table(load(strategy, folder))
+
+
+def load(strategy, folder="./strategies", since=None):
+    """
+    Load the stored allocations of a strategy as columns, all of them or the
+    ones after a date
+    """
+
+    path = _strategy_path(strategy, folder)
+    if len(_parts(path)) == 0:
+        allocations = _legacy(path)
+        if allocations is not None:
+            table = to_table(allocations)
+            return _after(table, since) if since is not None else table
+    return read_table(path, since)
+
+
+def last_date(strategy, folder="./strategies"):
+    """
+    Last stored date of a strategy, read from the last part only
+    """
+
+    parts = _parts(_strategy_path(strategy, folder))
+    if len(parts) == 0:
+        return None
+    with np.load(parts[-1]) as f:
+        return str(f["date"].max())
+
+
+def first_date(strategy, folder="./strategies"):
+    """
+    First stored date of a strategy, read from the first part only
+    """
+
+    parts = _parts(_strategy_path(strategy, folder))
+    if len(parts) == 0:
+        return None
+    with np.load(parts[0]) as f:
+        return str(f["date"].min())
+
+
+def prepend(strategy, allocations, folder="./strategies"):
+    """
+    Insert allocations (dict of date -> allocations) before the stored ones,
+    rewriting the stored history as one part
+    """
+
+    path = _strategy_path(strategy, folder)
+    table = to_table(allocations)
+    if len(table["date"]) == 0:
+        return
+    parts = _parts(path)
+    if len(parts) == 0:
+        append_table(path, table)
+        return
+    stored = read_table(path)
+    table = {
+        col: np.concatenate([table[col], stored[col]]) for col in table if col in stored
+    }
+    # The merged part is written before the old ones are removed
+    n = int(os.path.basename(parts[-1])[5:10]) + 1
+    _write_part(os.path.join(path, "part-{:05d}.npz".format(n)), table)
+    for part in parts:
+        os.remove(part)
+
+
+def append(strategy, allocations, folder="./strategies"):
+    """
+    Append allocations (dict of date -> allocations) after the stored ones,
+    without rewriting the stored history
+    """
+
+    append_table(_strategy_path(strategy, folder), to_table(allocations))
+
+
+def _legacy(path):
+    """
+    Allocations of a JSON lines or legacy JSON strategy file, if any
+    """
+
+    if os.path.exists(path + ".jsonl"):
+        allocations = dict()
+        with open(path + ".jsonl", "r") as f:
+            for line in f:
+                if line.strip():
+                    allocations.update(json.loads(line))
+        return allocations
+    if os.path.exists(path + ".json"):
+        return json.load(open(path + ".json", "r"))
+    return None
+
+
+def migrate(strategy, folder="./strategies"):
+    """
+    Convert a JSON lines or legacy JSON strategy file to the columnar format,
+    once
+    """
+
+    path = _strategy_path(strategy, folder)
+    if len(_parts(path)) > 0:
+        return
+
+    allocations = _legacy(path)
+    if allocations:
+        append(strategy, allocations, folder)
+
+
+def export_json(strategy, folder="./strategies"):
+    """
+    Export a strategy to the legacy pretty-printed JSON file
+    """
+
+    write(_strategy_path(strategy, folder), read(strategy, folder), fmt="json")
@@ -0,0 +1,80 @@
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+import pytest
+
+from data.downloader import Downloader
+
+
+class Handler(BaseHTTPRequestHandler):
+    """
+    Stand-in API: /flaky answers 429 with Retry-After, then 500, then the
+    data, and /down always answers 500
+    """
+
+    calls = dict()
+
+    def do_GET(self):
+        path = self.path.split("?")[0]
+        n = self.calls[path] = self.calls.get(path, 0) + 1
+        if path == "/flaky" and n == 1:
+            self.send_response(429)
+            self.send_header("Retry-After", "0.2")
+            self.end_headers()
+        elif path == "/down" or n == 2:
+            self.send_response(500)
+            self.end_headers()
+        else:
+            body = json.dumps({"status": {"error_code": 0}, "n": n}).encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def server():
+    Handler.calls = dict()
+    httpd = HTTPServer(("127.0.0.1", 0), Handler)
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    yield "http://127.0.0.1:{}".format(httpd.server_port)
+    httpd.shutdown()
+    httpd.server_close()
+
+
+def test_retries_throttled_and_server_errors(server):
+    downloader = Downloader(rate=100, burst=10, retries=3, backoff=0.01, timeout=5)
+    done = dict()
+    try:
+        begin = time.monotonic()
+        results = downloader.fetch(
+            [(server + "/flaky", {"id": 1})],
+            callback=lambda i, data: done.update({i: data}),
+        )
+        elapsed = time.monotonic() - begin
+    finally:
+        downloader.close()
+
+    assert results == [{"status": {"error_code": 0}, "n": 3}]
+    assert done == {0: results[0]}
+    assert Handler.calls == {"/flaky": 3}
+    assert elapsed >= 0.2  # held for the Retry-After delay
+
+
+def test_gives_up_after_the_retries(server):
+    downloader = Downloader(rate=100, burst=10, retries=3, backoff=0.01, timeout=5)
+    try:
+        results = downloader.fetch([(server + "/down", None), (server + "/ok", None)])
+    finally:
+        downloader.close()
+
+    assert results[0] is None
+    assert results[1]["n"] == 1
+    assert Handler.calls == {"/down": 4, "/ok": 1}
@@ -0,0 +1,40 @@
+from datetime import date, timedelta
+
+import numpy as np
+import pytest
+
+from benchmarks import synthetic
+from data.market import MarketStore
+from execution.backtest import Krypfolio
+from strategies.hodl import HODL
+
+
+@pytest.fixture(scope="module")
+def workspace(tmp_path_factory):
+    """
+    Allocations of a HODL strategy on a year of synthetic data
+    """
+
+    path = tmp_path_factory.mktemp("krypfolio")
+    with pytest.MonkeyPatch.context() as mp:
+        mp.chdir(path)
+        synthetic.write_processed(synthetic.series(12, 1, seed=1))
+        MarketStore().import_csv()
+        hodl = HODL(3, 8, 0.3)
+        hodl.main((date.today() - timedelta(days=300)).isoformat())
+        yield hodl.name
+
+
+@pytest.mark.parametrize("loss, r", [(0.12, 2), (0.05, 1), (1.0, 4)])
+def test_simulate_matches_walk(workspace, loss, r):
+    start = (date.today() - timedelta(days=250)).isoformat()
+    loop = Krypfolio(debug=False, engine="loop").main(
+        workspace, loss, r, start, write=False
+    )
+    array = Krypfolio(debug=False, engine="array").main(
+        workspace, loss, r, start, write=False
+    )
+
+    assert len(loop) > 200
+    assert (loop.index == array.index).all()
+    np.testing.assert_array_equal(loop.values, array.values)